@@ -0,0 +1,120 @@
+# File: BenchmarkRecovery.py
+# Author: David Simonneti (dsimone2@nd.edu) & John Lee (jlee88@nd.edu)
+#
+# Description: Benchmark of how long a replicator takes to serve again after a crash. For every size, a synthetic checkpoint
+# of that many users and a transaction log of that many transactions are written, then a replicator is started on them
+# and timed until it answers a request, like a broker would send after the crash.
+# usage:
+#   python BenchmarkRecovery.py <proj_name> <records> [<records> ...]
+#   e.g. python BenchmarkRecovery.py bench 10000 100000 1000000 10000000
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from StockMarketLib import format_message, receive_data
+from StockMarketWAL import WriteAheadLog
+
+REPLICATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Replicator.py")
+# how long to wait on the background checkpoint after the replicator serves, in seconds
+CHECKPOINT_WAIT = 600
+
+def write_checkpoint(path, num_users, ckpt_time):
+    """Full checkpoint of num_users users, every tenth of them holding no stocks
+    """
+    with open(path, "w") as f:
+        f.write(f"{ckpt_time}\n")
+        for i in range(num_users):
+            username = f"user{i}"
+            stocks = {"TSLA": i % 10, "AAPL": 1} if i % 10 else {}
+            f.write(f"{len(username)} {username} 8 password {100000 - i % 1000} {json.dumps(stocks)}\n")
+
+def write_log(path, num_txns, num_users, start_time):
+    """Transaction log after the checkpoint: a register for every tenth transaction, buys and sells of the users for the rest
+    """
+    log = WriteAheadLog(path)
+    for i in range(num_txns):
+        time_ns = start_time + i + 1
+        if i % 10 == 0:
+            log.register(time_ns, f"new{i}", "password")
+        elif i % 2:
+            log.buy(time_ns, f"user{i % num_users}", "TSLA", 2, 100.0)
+        else:
+            log.sell(time_ns, f"user{(i - 1) % num_users}", "TSLA", 1, 101.0)
+    log.sync()
+    log.close()
+
+def peak_memory(pid):
+    """Peak resident memory of a process in MB, where /proc has it
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def time_to_serve(project_name, directory):
+    """Starts a replicator in directory, and returns how long it took to answer a balance request,
+    the recovery phases it printed and its peak memory
+    """
+    start = time.monotonic()
+    proc = subprocess.Popen([sys.executable, REPLICATOR, project_name, "0"], cwd=directory, stdout=subprocess.PIPE,
+                            text=True, env={**os.environ, "PYTHONUNBUFFERED": "1"})
+    # the replicator prints its port before it recovers, then a line per recovery phase
+    port = int(proc.stdout.readline().split()[-1])
+    phases = []
+    checkpointed = threading.Event()
+    def read_phases():
+        for line in proc.stdout:
+            if line.startswith("Recovery:"):
+                phases.append(line[len("Recovery:"):].strip())
+                if "written" in line:
+                    checkpointed.set()
+    threading.Thread(target=read_phases, daemon=True).start()
+
+    sock = socket.create_connection((socket.gethostname(), port))
+    # introduced as a broker, with the request right behind
+    sock.sendall(format_message({"type": "broker"}) + format_message({"action": "balance", "username": "user0", "password": "password"}))
+    status, response = receive_data(sock)
+    served = time.monotonic() - start
+    sock.close()
+    if status != 0 or not response or not response["Success"]:
+        print(f"Error: the replicator answered {response}")
+    checkpointed.wait(CHECKPOINT_WAIT)
+    memory = peak_memory(proc.pid)
+    proc.kill()
+    proc.wait()
+    return served, phases, memory
+
+def main():
+    if len(sys.argv) < 3:
+        print("Error: please enter project name and the numbers of records to benchmark")
+        exit(1)
+    try:
+        sizes = [int(size) for size in sys.argv[2:]]
+    except Exception:
+        print("Error: the numbers of records must be integers")
+        exit(1)
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            ckpt_time = time.time_ns()
+            write_checkpoint(os.path.join(directory, "table0.ckpt"), size, ckpt_time)
+            write_log(os.path.join(directory, "table0.wal"), size, size, ckpt_time)
+            ckpt_size = os.path.getsize(os.path.join(directory, "table0.ckpt")) / 2**20
+            log_size = os.path.getsize(os.path.join(directory, "table0.wal")) / 2**20
+            served, phases, memory = time_to_serve(sys.argv[1], directory)
+            print(f"{size} users ({ckpt_size:.1f} MB) + {size} transactions ({log_size:.1f} MB): serving after {served:.2f} seconds"
+                  + ("" if memory is None else f", peak memory {memory:.0f} MB"))
+            for phase in phases:
+                print(f"    {phase}")
+
+if __name__ == "__main__":
+    main()
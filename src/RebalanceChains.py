@@ -0,0 +1,48 @@
+# File: RebalanceChains.py
+# Author: David Simonneti (dsimone2@nd.edu) & John Lee (jlee88@nd.edu)
+#
+# Description: Script to move a running broker onto a different number of replicators, without restarting anything.
+# The admin password has to be in STOCKMARKET_ADMIN_PASSWORD, as it was for the broker.
+# usage:
+#   python RebalanceChains.py <proj_name> <num_replicators>
+
+import os
+import socket
+import sys
+from StockMarketLib import format_message, receive_data, lookup_server
+from StockMarketBroker import ADMIN_USERNAME, ADMIN_PASSWORD_ENV
+
+def main():
+    if len(sys.argv) != 3:
+        print("Error: please enter project name and the new number of replicators")
+        exit(1)
+    try:
+        num_chains = int(sys.argv[2])
+    except Exception:
+        print("Error: the number of replicators must be an integer")
+        exit(1)
+    password = os.environ.get(ADMIN_PASSWORD_ENV, None)
+    if password is None:
+        print(f"Error: please set {ADMIN_PASSWORD_ENV} to the broker's admin password")
+        exit(1)
+
+    # the new replicators have to be started first, the broker connects to them before moving any users
+    for broker in lookup_server(sys.argv[1], "stockmarketbroker"):
+        try:
+            sock = socket.create_connection((broker["name"], broker["port"]))
+        except Exception:
+            continue
+        sock.sendall(format_message({"action": "rebalance", "num_chains": num_chains, "username": ADMIN_USERNAME, "password": password}))
+        # the broker answers once every user has moved
+        status, response = receive_data(sock)
+        sock.close()
+        if status != 0 or not response:
+            print("Error: lost the connection to the broker")
+            exit(1)
+        print(response["Value"])
+        exit(0 if response["Success"] else 1)
+    print("Error: unable to connect to a broker")
+    exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -10,12 +10,37 @@ import os
 import json
 import select
 import signal
-from StockMarketLib import format_message, receive_data, print_debug, VALID_TICKERS, StockMarketUser
-from StockMarketBroker import StockMarketBroker
+from array import array
+from collections import OrderedDict
+from StockMarketLib import BufferedConnection, PriceTable, format_message, print_debug, VALID_TICKERS, StockMarketUser
+from StockMarketBroker import StockMarketBroker, BROKER_ACTIONS
+from StockMarketHashRing import HashRing
+from StockMarketLeaderboard import Leaderboard
+from StockMarketWAL import WriteAheadLog, convert_text_log, replay
+
+# price epochs kept around for requests that were priced at an older tick
+PRICE_EPOCHS = 256
+# how often the net worths that changed are pushed to the brokers, in seconds
+NET_WORTH_PUSH_INTERVAL = 0.5
+# most net worths checked per second. Every broker front-end spends about 25us putting a pushed net worth into its
+# leaderboard, so this keeps a replicator's pushes to about a tenth of a front-end's time even when every holder's
+# net worth moves with every tick. When a widely held ticker moves, its holders are pushed over several intervals
+NET_WORTH_PUSH_RATE = 4000
+# most users whose net worth is checked per push
+NET_WORTH_PUSH_LIMIT = int(NET_WORTH_PUSH_RATE * NET_WORTH_PUSH_INTERVAL)
+# how long logged transactions may wait for more to share their fsync, in seconds.
+# With no wait, a group holds the transactions of one pass over the broker connections
+GROUP_COMMIT_WINDOW = 0
+# most transactions made durable by a single fsync
+GROUP_COMMIT_SIZE = 1000
+# transactions logged between checkpoints
+CHECKPOINT_INTERVAL = 100
+# most delta checkpoints kept before they are compacted into a full checkpoint
+COMPACTION_INTERVAL = 16
 
 class Replicator(StockMarketBroker):
     
-    def __init__(self, project_name, chain_num):
+    def __init__(self, project_name, chain_num, group_window=GROUP_COMMIT_WINDOW, group_size=GROUP_COMMIT_SIZE):
         """Initializes the replicator server.
         
         Also opens a UDP connection to the name server
@@ -23,6 +48,8 @@ class Replicator(StockMarketBroker):
         Args:
             project_name (str): name of the project
             chain_num    (int): replicator number
+            group_window (float): how long logged transactions may wait for more to share their fsync, in seconds
+            group_size   (int): most transactions made durable by a single fsync
         """
         
         self.project_name = project_name
@@ -48,24 +75,65 @@ class Replicator(StockMarketBroker):
                 exit(1)
 
         self.port_number = self.socket.getsockname()[1]
-        print(f"Listening on port {self.port_number}")
         self.socket.listen()
+        print(f"Listening on port {self.port_number}")
         
         # for users and the leaderboard
         self.num_users = 0
         self.users = {}
-        self.leaderboard = []
-        # connection to broker 
-        self.broker_conn = None
+        self.leaderboard = Leaderboard()
+        # connections to the broker front-ends, every one of them forwards requests to us
+        self.broker_conns = []
+
+        ## Net worth pushes, so the broker's leaderboard only hears about users whose net worth changed
+        # users whose holdings changed since the last push
+        self.dirty_users = set()
+        # maps ticker -> usernames holding it, and username -> tickers it held when last indexed
+        self.holders = {}
+        self.holdings = {}
+        # maps username -> net worth last pushed to the broker
+        self.pushed = {}
+        # usernames whose net worth may have changed since it was pushed, oldest first after the users who traded
+        self.stale_users = OrderedDict()
+        # prices as of the last push, to find the tickers that moved since
+        self.marked_prices = None
+        self.next_push = 0
 
         # see if we need to perform a rebuild after a crash
         # if there is a checkpoint file or a transaction log, we will reload in stock market data from those files
         # set the txn_log to none to indicate that we are rebuilding from crash
         self.txn_log = None
-        self.rebuild_server()
-        # start new transaction log
-        self.txn_log = open(f"table{self.chain_num}.txn", "w")
+        # process writing a checkpoint in the background, see start_checkpoint
+        self.checkpoint_pid = None
+        ## Delta checkpoints: a background checkpoint only writes the users that changed since the one before it,
+        # until the deltas are compacted into a full checkpoint. Recovery loads the full checkpoint, then the deltas in order
+        # usernames changed since the last checkpoint was started
+        self.ckpt_dirty = set()
+        # numbers of the delta checkpoints written since the full checkpoint, and how many users they hold together
+        self.deltas = []
+        self.delta_entries = 0
+        self.next_delta = 0
+        # (number, users) of the delta the background checkpoint is writing, None while it writes a full checkpoint
+        self.checkpoint_delta = None
+        recovered = self.rebuild_server()
+        # everyone that was rebuilt gets pushed to the broker
+        self.dirty_users.update(self.users)
         self.txn_count = 0
+        ## Group commit: transactions are logged as they are performed, and made durable together by one fsync.
+        # Responses are held back until the transactions before them are durable
+        self.group_window = group_window
+        self.group_size = group_size
+        # transactions written since the last fsync, and when they have to be synced by
+        self.txn_unsynced = 0
+        self.group_deadline = None
+        # maps broker connection -> responses held until the next fsync
+        self.held = {}
+        # the replayed logs are rotated out and checkpointed in the background, so we serve without waiting on it
+        if recovered:
+            self.start_checkpoint(recovery=True)
+        else:
+            # start new transaction log
+            self.txn_log = WriteAheadLog(f"table{self.chain_num}.wal")
 
         # send information to name server
         self.ns_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -75,8 +143,13 @@ class Replicator(StockMarketBroker):
         signal.setitimer(signal.ITIMER_REAL, .1, 60) # now and every 60 seconds after
         
         self.select_socks = [self.socket]
-        # keep track of latest stock info
-        self.latest_stock_info = {}
+        # usernames this chain gives away in the rebalance in progress, with the ring they are moving to
+        self.migrating = None
+        # keep track of latest stock prices, ordered like the universe the broker tells us about
+        self.prices = PriceTable(VALID_TICKERS)
+        # maps epoch -> prices at that tick, as streamed by the brokers. Requests are priced at the epoch they name
+        self.price_epochs = OrderedDict()
+        self.latest_epoch = None
     
     ##################
     # Socket Methods #
@@ -88,21 +161,38 @@ class Replicator(StockMarketBroker):
 
     def accept_new_connection(self):
         """Accepts a new connection and adds it to the socket table.
+        The broker pipelines requests right behind its hello, so any requests that came with it are returned.
         """
         conn, addr = self.socket.accept()
-        conn.settimeout(60)
-        status, data = receive_data(conn)
+        conn = BufferedConnection(conn)
+        messages = []
+        # wait up to 60 seconds for the connection to tell us who they are
+        deadline = time.monotonic() + 60
+        while messages == []:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0 or not select.select([conn], [], [], remaining)[0]:
+                    messages = None
+                else:
+                    messages = conn.read()
+            except ValueError:
+                messages = None
         # if the connection doesnt tell us who they are, we ignore them
-        if data is None or status == 2:
-            return
-        # if the connection is the broker
-        if data["type"] == "broker":
-            # update the broker connection to point to the new one
-            if self.broker_conn:
-                self.select_socks.remove(self.broker_conn)
-                self.broker_conn.close()
-            self.broker_conn = conn
+        if messages is None or not isinstance(messages[0], dict):
+            conn.close()
+            return []
+        data = messages[0]
+        # if the connection is a broker front-end. One that restarted leaves its old connection behind until it reads as closed
+        if data.get("type", None) == "broker":
+            self.broker_conns.append(conn)
             self.select_socks.append(conn)
+            if data.get("tickers") is not None and data["tickers"] != self.prices.tickers:
+                self.prices = PriceTable(data["tickers"])
+                self.price_epochs.clear()
+                self.latest_epoch = None
+            return messages[1:]
+        conn.close()
+        return []
     
     ###############
     # API Backend #
@@ -116,7 +206,7 @@ class Replicator(StockMarketBroker):
             err = f"Username {username} is already in use."
             print_debug(err)
             return self.json_resp(False, err)
-        self.write_txn(f"{time.time_ns()} REGISTER {len(username)} {username} {len(password)} {password}\n")
+        self.write_txn("register", username, password)
         self.users[username] = StockMarketUser(username, password)
         print_debug(f"User {username} was registered.")
         return self.json_resp(True, None)
@@ -144,7 +234,7 @@ class Replicator(StockMarketBroker):
         """
         # check valid ticker to buy
         ticker = request.get("ticker", None)
-        if ticker not in VALID_TICKERS or ticker is None:
+        if ticker is None or ticker not in self.prices:
             err = f"Ticker {ticker} is not valid."
             user.print_debug(err)
             return self.json_resp(False, f"Ticker {ticker} is not valid.")
@@ -173,11 +263,11 @@ class Replicator(StockMarketBroker):
                 return self.json_resp(True, succ )
         
         # snapshot buy price
-        buy_price = self.latest_stock_info[ticker]
+        buy_price = self.prices[ticker]
         
         # can purchase
         if user.can_purchase(amount, buy_price):
-            self.write_txn(f"{time.time_ns()} BUY {len(user.username)} {user.username} {ticker} {amount} {buy_price}\n")
+            self.write_txn("buy", user.username, ticker, amount, buy_price)
             user.purchase(ticker, amount, buy_price)
             succ = f"Purchased {amount} shares of {ticker} at {buy_price}"
             user.print_debug(succ)
@@ -194,7 +284,7 @@ class Replicator(StockMarketBroker):
         """
         # check valid ticker to buy
         ticker = request.get("ticker", None)
-        if ticker not in VALID_TICKERS or ticker is None:
+        if ticker is None or ticker not in self.prices:
             err =  f"Ticker {ticker} is not valid."
             user.print_debug(err)
             return self.json_resp(False, err)
@@ -223,11 +313,11 @@ class Replicator(StockMarketBroker):
                 return self.json_resp(True, succ)
             
         # snapshot sell price
-        sell_price = self.latest_stock_info[ticker]
+        sell_price = self.prices[ticker]
         
         # can sell
         if user.can_sell(amount, ticker):
-            self.write_txn(f"{time.time_ns()} SELL {len(user.username)} {user.username} {ticker} {amount} {sell_price}\n")
+            self.write_txn("sell", user.username, ticker, amount, sell_price)
             user.sell(ticker, amount, sell_price)
             succ = f"Sold {amount} shares of {ticker} at {sell_price}"
             user.print_debug(succ)
@@ -243,7 +333,7 @@ class Replicator(StockMarketBroker):
         """Gets a user's balance
         """
         # net worth
-        worth = self._net_worth(user, self.latest_stock_info)
+        worth = self._net_worth(user, self.prices)
         
         # string representation & data repr
         user_rep = str(user) + f"Net Worth: {worth}"
@@ -251,25 +341,81 @@ class Replicator(StockMarketBroker):
         user.print_debug("\n" + user_rep)
         return self.json_resp(True, resp)
     
-    def _net_worth(self, user: StockMarketUser, stock_info):
+    def _net_worth(self, user: StockMarketUser, prices):
         """Compute the net worth of an individual at a certian stock price
         """
-        nw = user.cash
-        for t in VALID_TICKERS:
-            nw += user.stocks[t] * stock_info[t]
-        return nw
+        return user.net_worth(prices)
 
     def _calculate_net_worths(self):
         """ Calculates net worth of all users
         """
-        # snapshot stock information
-        freeze_price = self.latest_stock_info.copy()
         # for every user, compute net worth
         net_worths = {}
         for user in self.users:
-            net_worths[user] = self._net_worth(self.users[user], freeze_price)
+            net_worths[user] = self._net_worth(self.users[user], self.prices)
         return net_worths
         
+    #####################
+    # Migration Methods #
+    #####################
+
+    def _migrate_out(self, request):
+        """Returns up to request["limit"] records of users this chain does not own on request["ring"].
+        Records stay here until the broker drops them, so the same batch comes back if it wasn't stored elsewhere
+        """
+        try:
+            ring = HashRing.from_json(request["ring"])
+            limit = int(request.get("limit", 500))
+        except Exception:
+            return self.json_resp(False, "Invalid ring")
+        # work out who is moving once per rebalance, rather than once per batch
+        if self.migrating is None or self.migrating[0] != ring:
+            self.migrating = (ring, {username: None for username in self.users if ring.lookup(username) != self.chain_num})
+        moving = self.migrating[1]
+        records = []
+        for username in moving:
+            if len(records) >= limit:
+                break
+            user = self.users[username]
+            records.append({"username": username, "password": user.password, "cash": user.cash, "stocks": user.stocks})
+        if not records:
+            self.migrating = None
+        return self.json_resp(True, records)
+
+    def _migrate_in(self, request):
+        """Stores user records moved here from another chain, replacing any earlier copy.
+        They are logged like any transaction, so the response waits on their group commit
+        """
+        try:
+            users = []
+            for record in request["records"]:
+                user = StockMarketUser(record["username"], record["password"])
+                user.cash = float(record["cash"])
+                user.stocks = {ticker: int(amount) for ticker, amount in record["stocks"].items() if amount != 0}
+                if not isinstance(user.username, str) or not isinstance(user.password, str):
+                    raise TypeError
+                users.append(user)
+        except Exception:
+            return self.json_resp(False, "Invalid records")
+        for user in users:
+            self.write_txn("store", user.username, user.password, user.cash, user.stocks)
+            self.users[user.username] = user
+            self.dirty_users.add(user.username)
+        return self.json_resp(True, len(users))
+
+    def _migrate_drop(self, request):
+        """Forgets users that were stored by their new chain
+        """
+        for username in request.get("usernames", []):
+            if self.users.pop(username, None) is not None:
+                self.write_txn("drop", username)
+            # the new chain pushes this user's net worth from now on
+            self.dirty_users.add(username)
+            self.pushed.pop(username, None)
+            if self.migrating is not None:
+                self.migrating[1].pop(username, None)
+        return self.json_resp(True, None)
+
     ###################
     # Request Handler #
     ###################
@@ -289,13 +435,20 @@ class Replicator(StockMarketBroker):
         if username is None: return self.json_resp(False, "Username not provided.")
         password = request.get("password", None)
         if password is None: return self.json_resp(False, "Password not provided")
-        if self.latest_stock_info == None:
-            return self.json_resp(False, "Malformed request")
+        # only the broker may poll us or move users, see StockMarketBroker.start_request
+        if action in BROKER_ACTIONS and request.get("broker", None) is not True:
+            return self.json_resp(False, f"{action} can only be requested by the broker")
 
         # if the broker is polling us for leaderboard information, send it back all of our clients and their net worth
         if action == "broker_leaderboard":
-            self.latest_stock_info = request.get("latest_stock_info", self.latest_stock_info)
             return self.json_resp(True, self._calculate_net_worths())
+        # the broker is moving users between chains
+        elif action == "migrate_out":
+            return self._migrate_out(request)
+        elif action == "migrate_in":
+            return self._migrate_in(request)
+        elif action == "migrate_drop":
+            return self._migrate_drop(request)
         # register the user
         elif action == 'register':
             return self._register_user(username, password)
@@ -326,170 +479,460 @@ class Replicator(StockMarketBroker):
     # Persistence Methods #
     #######################
     
-    def rebuild_server(self):
-        """Rebuild the server by reading through ckpt & transaction log
+    def _load_checkpoint(self, path):
+        """Reads a full or delta checkpoint into memory a line at a time. Returns the time it was made
         """
-        # time the last checkpoint was made - used to see which transactions from the transactions log we should actually play back
-        ckpt_time = 0
-        # only rebuild from checkpoint if the file exists
-        if os.path.isfile(f"table{self.chain_num}.ckpt"):
-            f = open(f"table{self.chain_num}.ckpt", "r")
+        users = self.users
+        # decodes the holdings without the whitespace checks of json.loads, a checkpoint has none
+        decode = json.JSONDecoder().raw_decode
+        with open(path, "r") as f:
             # first line of checkpoint file is timestamp of when checkpoint was made 
             ckpt_time = int(f.readline())
             # read in state of hash table line by line
-            for line in f.readlines():
+            for line in f:
+                # users dropped since the checkpoint before a delta, see _write_checkpoint
+                if line.startswith("DELETE "):
+                    username_len, rest = line[len("DELETE "):].split(" ", 1)
+                    users.pop(rest[:int(username_len)], None)
+                    continue
                 # the length of the username is seperated from the rest of the entry by the first space in the line
-                username_len, rest = line.strip("\n").split(" ", 1)
-                # convert to int
-                username_len = int(username_len)
+                username_len, rest = line.split(" ", 1)
                 # read in the key as that many characters
+                username_len = int(username_len)
                 username = rest[:username_len]
 
                 # same for pw
                 pw_len, rest = rest[username_len + 1:].split(" ", 1)
-                # convert to int
                 pw_len = int(pw_len)
-                # read in the key as that many characters
                 password = rest[:pw_len]
 
                 # cash and stock amounts are the rest of the entry
                 cash, stocks = rest[pw_len + 1:].split(" ", 1)
-                cash = float(cash)
-                stocks = json.loads(stocks)
+                user = StockMarketUser(username, password)
+                user.cash = float(cash)
+                # only tickers that are actually held are kept, and users holding nothing skip the decode
+                if stocks != "{}\n":
+                    user.stocks = {ticker: amount for ticker, amount in decode(stocks)[0].items() if amount != 0}
                 # add the entry to memory
-                self.users[username] = StockMarketUser(username, password)
-                self.users[username].cash = cash
-                self.users[username].stocks = stocks
-        # once we have rebuild from the checkpoint, attempt to play back the transaction log if it exists
+                users[username] = user
+        return ckpt_time
+
+    def _delta_path(self, number):
+        return f"table{self.chain_num}.delta{number}"
+
+    def _rotated_logs(self):
+        """Paths of the logs rotated out by checkpoints that are not in place yet, oldest first
+        """
+        prefix = f"table{self.chain_num}.wal."
+        numbers = sorted(int(name[len(prefix):]) for name in os.listdir(".") if name.startswith(prefix) and name[len(prefix):].isdigit())
+        return [f"{prefix}{number}" for number in numbers]
+
+    def _remove_rotated_logs(self):
+        for path in self._rotated_logs():
+            os.remove(path)
+
+    def rebuild_server(self):
+        """Rebuild the server by reading through the full checkpoint, the delta checkpoints after it & the transaction logs.
+        Every file is streamed, and how long each phase took is printed. Returns whether any log was replayed,
+        those logs are only removed once a checkpoint holds them, see start_checkpoint
+        """
+        # time the last checkpoint was made - used to see which transactions from the transactions log we should actually play back
+        ckpt_time = 0
+        start = time.monotonic()
+        # only rebuild from checkpoint if the file exists
+        if os.path.isfile(f"table{self.chain_num}.ckpt"):
+            ckpt_time = self._load_checkpoint(f"table{self.chain_num}.ckpt")
+        # then every delta, oldest first. Deltas that were already compacted into the full checkpoint are older than it
+        prefix = f"table{self.chain_num}.delta"
+        self.deltas = sorted(int(name[len(prefix):]) for name in os.listdir(".") if name.startswith(prefix) and name[len(prefix):].isdigit())
+        for number in self.deltas:
+            with open(self._delta_path(number), "r") as f:
+                delta_time = int(f.readline())
+            if delta_time > ckpt_time:
+                ckpt_time = self._load_checkpoint(self._delta_path(number))
+        if self.deltas:
+            self.next_delta = self.deltas[-1] + 1
+        print(f"Recovery: loaded {len(self.users)} users from checkpoints in {time.monotonic() - start:.2f} seconds")
+
+        # a text transaction log from before the binary log is converted first, then the binary log holds its transactions
         if os.path.isfile(f"table{self.chain_num}.txn"):
-            f = open(f"table{self.chain_num}.txn", "r")
-            # go line by line through the log
-            for line in f.readlines():
-                # format of each entry in the log is as such
-                # TRANSACTION_LENGTH TIMESTAMP OPERATION USERNAME_LEN USERNAME TICKER AMOUNT PRICE
-                # transaction_length is the total size of the transaction, to ensure no partial transactions get read
-                # timestamp is the time in ns when the operation happened
-                # OPERATION is either buy or sell
-                # USERNAME_LEN is the length of USERNAME
-                # TICKER, AMOUNT, and PRICE detail the contents of the transaction
-                # each item is delimited by a space
-
-                # read total transaction length and make sure it lines up
-                total_length, rest = line.strip("\n").split(" ", 1)
-                if len(rest) != int(total_length):
-                    # otherwise, if we encounter a half completed transaction we just skip it
-                    continue
-                # get the timestamp from an entry - delimited by first space
-                time, rest = rest.strip("\n").split(" ", 1)
-                time = int(time)
+            if not os.path.isfile(f"table{self.chain_num}.wal"):
+                count = convert_text_log(f"table{self.chain_num}.txn", f"table{self.chain_num}.wal")
+                print(f"Converted {count} transactions from table{self.chain_num}.txn")
+            os.remove(f"table{self.chain_num}.txn")
+        # once we have rebuild from the checkpoint, attempt to play back the transaction logs if they exist.
+        # The logs rotated out by background checkpoints that did not finish come before the current one
+        start = time.monotonic()
+        logs = self._rotated_logs()
+        if os.path.isfile(f"table{self.chain_num}.wal"):
+            logs.append(f"table{self.chain_num}.wal")
+        users = self.users
+        count = 0
+        for path in logs:
+            # replay stops at a transaction that was cut short by the crash, see StockMarketWAL.replay
+            for txn in replay(path):
                 # we only replay this operation if it occured AFTER the latest checkpoint
-                if time > ckpt_time:
-                    # read the operation from the entry - delimited by second space
-                    operation, rest = rest.split(" ", 1)
-                    # if its an insert
-                    if operation == "BUY":
-                        # get the key length, which is delimited by the third space
-                        username_len, rest = rest.split(" ", 1)
-                        username_len = int(username_len)
-                        # get the key and then the value is the rest of the entry
-                        username = rest[:username_len]
-                        ticker, amount, price = rest[username_len + 1:].split(" ")
-                        # perform operation
-                        self.users[username].purchase(ticker, float(amount), float(price))
-                    elif operation == "SELL":
-                        # get the key length, which is delimited by the third space
-                        username_len, rest = rest.split(" ", 1)
-                        username_len = int(username_len)
-                        # get the key and then the value is the rest of the entry
-                        username = rest[:username_len]
-                        ticker, amount, price = rest[username_len + 1:].split(" ")
-                        # perform operation
-                        self.users[username].sell(ticker, float(amount), float(price))
-                    elif operation == "REGISTER":
-                        username_len, rest = rest.split(" ", 1)
-                        username_len = int(username_len)
-                        # get the key and then the value is the rest of the entry
-                        username = rest[:username_len]
-                    
-                        pw_len, rest = rest[username_len + 1:].split(" ", 1)
-                        pw_len = int(pw_len)
-                        # get the key and then the value is the rest of the entry
-                        password = rest[:pw_len]
-                        self._register_user(username, password)
-            # once we are done replaying all transactions, create a new checkpoint so we can delete the old transaction log
-            self.create_checkpoint()
+                if txn[1] <= ckpt_time:
+                    continue
+                operation = txn[0]
+                if operation == "BUY":
+                    users[txn[2]].purchase(txn[3], txn[4], txn[5])
+                elif operation == "SELL":
+                    users[txn[2]].sell(txn[3], txn[4], txn[5])
+                elif operation == "REGISTER" and txn[2] not in users:
+                    users[txn[2]] = StockMarketUser(txn[2], txn[3])
+                # users moved between chains by a rebalance
+                elif operation == "STORE":
+                    user = users[txn[2]] = StockMarketUser(txn[2], txn[3])
+                    user.cash = txn[4]
+                    user.stocks = txn[5]
+                elif operation == "DROP":
+                    users.pop(txn[2], None)
+                count += 1
+        if logs:
+            print(f"Recovery: replayed {count} transactions from {len(logs)} logs in {time.monotonic() - start:.2f} seconds")
+        return bool(logs)
 
-    def write_txn(self, message):
-        """Writes TXN file
+    def write_txn(self, operation, *fields):
+        """Writes a register, buy, sell, store or drop transaction to the log, see StockMarketWAL for the format
         """
         if self.txn_log == None:
             return
-        # write transaction message to log
-        # prepend length of transaction so we know if we had an incomplete write
-        self.txn_log.write(f"{len(message) - 1} {message}")
-        # flush and fsync to send data directly to disk
-        self.txn_log.flush()
-        os.fsync(self.txn_log)
-        # another successful transaction
+        # every record is framed with its length and CRC32, so a half written one is caught on replay
+        getattr(self.txn_log, operation)(time.time_ns(), *fields)
+        # the user goes in the next delta checkpoint
+        self.ckpt_dirty.add(fields[0])
+        # another successful transaction, durable once its group is committed
         self.txn_count += 1
+        self.txn_unsynced += 1
+        if self.group_deadline is None:
+            self.group_deadline = time.monotonic() + self.group_window
         print_debug("TXN LOG written.")
 
-    def create_checkpoint(self):
-        """Writes CKPT file
+    def commit(self):
+        """Makes every transaction logged so far durable with a single flush and fsync,
+        then lets the responses that waited on them go to the brokers
+        """
+        if self.txn_unsynced:
+            # flush and fsync to send data directly to disk
+            self.txn_log.sync()
+            print_debug(f"TXN LOG synced {self.txn_unsynced} transactions.")
+            self.txn_unsynced = 0
+        self.group_deadline = None
+        for conn, responses in self.held.items():
+            try:
+                conn.send(responses)
+            except OSError:
+                pass
+        self.held.clear()
+
+    def _write_checkpoint(self, path, ckpt_time, usernames=None):
+        """Writes a CKPT file as of ckpt_time, of every user or only of usernames for a delta.
+        Users in usernames that no longer exist are written as DELETE entries
         """
-        # open shadow checkpoint file to begin checkpointing
-        shadow_ckpt = open("./table.ckpt.shadow", "w")
-        # write the current time as a header 
-        shadow_ckpt.write(f"{time.time_ns()}\n")
+        # open shadow checkpoint file to begin checkpointing, named after the chain so replicators can share a directory
+        shadow_path = f"./{path}.shadow"
+        shadow_ckpt = open(shadow_path, "w")
+        # write the time as a header, the transactions logged up to it are in the checkpoint
+        shadow_ckpt.write(f"{ckpt_time}\n")
         # iterate over every key value pair currently in the hash table and write it to the checkpoint file
-        for username in self.users.keys():
-            user = self.users[username]
+        for username in (self.users.keys() if usernames is None else usernames):
+            user = self.users.get(username)
+            if user is None:
+                shadow_ckpt.write(f"DELETE {len(username)} {username}\n")
+                continue
             shadow_ckpt.write(f"{len(username)} {username} {len(user.password)} {user.password} {user.cash} {json.dumps(user.stocks)}\n")
-
+        shadow_ckpt.flush()
+        os.fsync(shadow_ckpt)
         shadow_ckpt.close()
         # perform atomic update of checkpoint
-        os.rename("./table.ckpt.shadow", f"./table{self.chain_num}.ckpt")
-        # clear out the old transaction log only if we are compressing during normal operation. Otherwise, if we are restarting from a crash, the server will already overwrite the transaction log.
-        if self.txn_log != None:
+        os.rename(shadow_path, f"./{path}")
+
+    def _remove_deltas(self):
+        """Removes the delta checkpoints, once a full checkpoint holds everything in them
+        """
+        for number in self.deltas:
+            if os.path.isfile(self._delta_path(number)):
+                os.remove(self._delta_path(number))
+        self.deltas = []
+        self.delta_entries = 0
+
+    def create_checkpoint(self):
+        """Writes a full CKPT file, blocking until it is done. Used when a background checkpoint failed
+        """
+        # a background checkpoint would rename its file over this one
+        self._reap_checkpoint(block=True)
+        self._write_checkpoint(f"table{self.chain_num}.ckpt", time.time_ns())
+        self.ckpt_dirty.clear()
+        self._remove_deltas()
+        # clear out the old transaction logs, everything in them is in the checkpoint
+        self.txn_log.close()
+        self.txn_log = WriteAheadLog(f"table{self.chain_num}.wal")
+        self._remove_rotated_logs()
+        print_debug("CKPT created.")
+
+    def start_checkpoint(self, recovery=False):
+        """Checkpoints in a forked child, which writes its copy-on-write snapshot of the users while we keep serving.
+        Only the users changed since the last checkpoint are written, as a delta, until there are COMPACTION_INTERVAL deltas
+        or they hold as many users as a full checkpoint would, then a full checkpoint replaces them.
+        The log is rotated at the snapshot: the transactions in it move to table<n>.wal.<k>, which is removed
+        once the checkpoint is in place, see _reap_checkpoint. After a crash, the recovery checkpoint is a full one
+        covering the logs that were replayed
+        """
+        if self.checkpoint_pid is not None:
+            return
+        # every transaction in the rotated log is durable and answered before the snapshot
+        self.commit()
+        ckpt_time = time.time_ns()
+        if self.txn_log is not None:
             self.txn_log.close()
-            self.txn_log = open(f"table{self.chain_num}.txn", "w")
-            
-        print_debug("CKPT created.")     
+        if os.path.isfile(f"table{self.chain_num}.wal"):
+            # after the logs already rotated out, so they are replayed in order
+            rotated = self._rotated_logs()
+            number = int(rotated[-1].rsplit(".", 1)[1]) + 1 if rotated else 1
+            os.replace(f"table{self.chain_num}.wal", f"table{self.chain_num}.wal.{number}")
+        self.txn_log = WriteAheadLog(f"table{self.chain_num}.wal")
+        if recovery or len(self.deltas) >= COMPACTION_INTERVAL or self.delta_entries + len(self.ckpt_dirty) >= len(self.users):
+            path, usernames = f"table{self.chain_num}.ckpt", None
+            self.checkpoint_delta = None
+        else:
+            path, usernames = self._delta_path(self.next_delta), self.ckpt_dirty
+            self.checkpoint_delta = (self.next_delta, len(usernames))
+            self.next_delta += 1
+        pid = os.fork()
+        if pid == 0:
+            # the child only writes the checkpoint, and leaves without running any of our cleanup
+            status = 1
+            try:
+                start = time.monotonic()
+                self._write_checkpoint(path, ckpt_time, usernames)
+                if recovery:
+                    print(f"Recovery: checkpoint written in the background in {time.monotonic() - start:.2f} seconds", flush=True)
+                status = 0
+            finally:
+                os._exit(status)
+        self.checkpoint_pid = pid
+        # the child has its own copy of the users it writes
+        self.ckpt_dirty = set()
+
+    def _reap_checkpoint(self, block=False):
+        """Finishes the background checkpoint once its child exited, checkpointing in the foreground if it failed
+        """
+        if self.checkpoint_pid is None:
+            return
+        pid, status = os.waitpid(self.checkpoint_pid, 0 if block else os.WNOHANG)
+        if pid == 0:
+            return
+        self.checkpoint_pid = None
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            if self.checkpoint_delta is None:
+                # the full checkpoint holds every delta before it
+                self._remove_deltas()
+            else:
+                self.deltas.append(self.checkpoint_delta[0])
+                self.delta_entries += self.checkpoint_delta[1]
+            self._remove_rotated_logs()
+            print_debug("CKPT created.")
+        else:
+            print("Background checkpoint failed, checkpointing in the foreground")
+            self.create_checkpoint()
+
+    def _reindex_holdings(self, username):
+        """Moves a user to the holders of the tickers it holds now
+        """
+        for ticker in self.holdings.pop(username, ()):
+            self.holders[ticker].discard(username)
+        user = self.users.get(username)
+        if user is not None:
+            self.holdings[username] = set(user.stocks)
+            for ticker in user.stocks:
+                self.holders.setdefault(ticker, set()).add(username)
+
+    def _net_worth_deltas(self):
+        """Net worths (to the cent) that changed since the last push, for users who traded
+        or hold a ticker whose price moved, so the cost follows activity rather than the number of users.
+        At most NET_WORTH_PUSH_LIMIT users are checked, the rest wait for the next push, so the leaderboard is this stale at most:
+        - users who traded are pushed by the next push, within NET_WORTH_PUSH_INTERVAL, while fewer than NET_WORTH_PUSH_LIMIT trade per interval
+        - users whose net worth only moved with prices wait behind the other stale users, up to (stale users) / NET_WORTH_PUSH_RATE seconds,
+          e.g. 25 seconds for 100k holders of a ticker that moves every tick. The broker's full resync every UPDATE_INTERVAL caps that too
+        """
+        prices = self.prices.prices
+        if self.marked_prices is None or len(self.marked_prices) != len(prices):
+            users = set(self.users)
+        else:
+            users = set()
+            tickers = self.prices.tickers
+            for index, (old, new) in enumerate(zip(self.marked_prices, prices)):
+                if old != new:
+                    users.update(self.holders.get(tickers[index], ()))
+        self.marked_prices = prices[:]
+        stale = self.stale_users
+        for username in users:
+            if username not in stale:
+                stale[username] = None
+        # users who traded go first
+        for username in self.dirty_users:
+            self._reindex_holdings(username)
+            stale[username] = None
+            stale.move_to_end(username, last=False)
+        self.dirty_users.clear()
+        deltas = {}
+        for _ in range(min(len(stale), NET_WORTH_PUSH_LIMIT)):
+            username, _ = stale.popitem(last=False)
+            user = self.users.get(username)
+            if user is None:
+                continue
+            net_worth = round(self._net_worth(user, self.prices), 2)
+            if self.pushed.get(username) != net_worth:
+                self.pushed[username] = net_worth
+                deltas[username] = net_worth
+        return deltas
+
+    def _apply_tick(self, tick):
+        """Stores the prices of a tick streamed by a broker, either every price or the changes since its base epoch.
+        Changes on an epoch we never got are dropped, the broker's next snapshot catches us up
+        """
+        epoch = tick["epoch"]
+        if "latest_prices" in tick:
+            prices = array("d", tick["latest_prices"])
+            if len(prices) != len(self.prices.tickers):
+                return
+            # a restarted simulator counts epochs from the start again, so the epochs from before it are stale.
+            # Another front-end's snapshot of an epoch we already have is only late
+            if (self.latest_epoch is not None and epoch < self.latest_epoch
+                    and self.price_epochs.get(epoch) != prices):
+                self.price_epochs.clear()
+                self.latest_epoch = None
+        else:
+            base = self.price_epochs.get(tick.get("base", None))
+            if base is None:
+                return
+            # epochs are never changed once stored, a request may still be priced at the base
+            prices = base[:]
+            try:
+                for index, price in tick["entries"]:
+                    prices[index] = price
+            except (IndexError, TypeError, ValueError):
+                return
+        self.price_epochs[epoch] = prices
+        self.price_epochs.move_to_end(epoch)
+        if self.latest_epoch is None or epoch > self.latest_epoch:
+            self.latest_epoch = epoch
+        while len(self.price_epochs) > PRICE_EPOCHS:
+            self.price_epochs.popitem(last=False)
+
+    def _use_epoch(self, epoch):
+        """Prices the next requests at an epoch, or at the latest one if it is unknown
+        """
+        prices = self.price_epochs.get(epoch)
+        if prices is None:
+            epoch = self.latest_epoch
+            prices = self.price_epochs.get(epoch)
+            if prices is None:
+                return
+        self.prices.prices = prices
+        self.prices.seq = epoch
+
+    def serve_request(self, data):
+        """Performs one request forwarded by the broker, echoing its request id so the broker can match up the response
+        """
+        if not isinstance(data, dict):
+            return self.json_resp(False, "Unintelligable request")
+        # price the request at the tick the broker saw when it forwarded it
+        if "epoch" in data:
+            self._use_epoch(data["epoch"])
+        response = self.perform_request(data)
+        if response.get("Success", False) and data.get("action", None) in ("register", "buy", "sell"):
+            self.dirty_users.add(data["username"])
+        if "id" in data:
+            response = {**response, "id": data["id"]}
+        return response
 
     def listen(self):
 
         while True:
 
-            # checkpoint after 100 transactions
-            if self.txn_count >= 100:
-                self.create_checkpoint()
+            # checkpoint in the background every CHECKPOINT_INTERVAL transactions, once the last one finished
+            self._reap_checkpoint()
+            if self.txn_count >= CHECKPOINT_INTERVAL and self.checkpoint_pid is None:
+                self.start_checkpoint()
                 self.txn_count = 0
             
-            readable, _, _ = select.select(self.select_socks, [], [], 5)
+            # only wait on a broker being writable while responses are still queued for it
+            writing = [conn for conn in self.broker_conns if conn.outbuf]
+            timeout = 5 if self.group_deadline is None else max(0, self.group_deadline - time.monotonic())
+            readable, writable, _ = select.select(self.select_socks, writing, [], timeout)
 
-            if readable == []:
+            if readable == [] and writable == []:
+                if self.group_deadline is not None and time.monotonic() >= self.group_deadline:
+                    self.commit()
                 continue
 
+            # maps broker connection -> requests it sent, so every response goes back the way its request came
+            requests = {}
             # new incoming broker conn
             if self.socket in readable:
-                self.accept_new_connection()
+                messages = self.accept_new_connection()
+                if messages:
+                    requests[self.broker_conns[-1]] = messages
                 readable.remove(self.socket)
 
-            # broker is forwarding us a request
-            if self.broker_conn in readable:
-                status, data = receive_data(self.broker_conn)
-                if status == 0 and data != None:
-                    # update the latest stock info from new request
-                    self.latest_stock_info = data.get("latest_stock_info", self.latest_stock_info)
-                    # perform the request and forward it back
-                    RPC_response = self.perform_request(data)
-                    RPC_response = format_message(RPC_response)
+            # brokers are forwarding us requests, possibly several at once
+            for conn in readable:
+                try:
+                    messages = conn.read()
+                except ValueError:
+                    # a badly framed stream can't be resynchronized, so drop it and let the broker reconnect
+                    messages = None
+                if messages is None:
+                    # the broker went away, it will reconnect to us
+                    self.select_socks.remove(conn)
+                    self.broker_conns.remove(conn)
+                    self.held.pop(conn, None)
+                    conn.close()
                 else:
-                    RPC_response = format_message(self.json_resp(False, "Unintelligable request"))
+                    requests[conn] = requests.get(conn, []) + messages
+
+            for conn in self.broker_conns:
+                # requests are performed in the order the broker sent them, and their responses go back in one write
+                responses = bytearray()
+                for data in requests.get(conn, []):
+                    # ticks streamed by the broker have no response
+                    if isinstance(data, dict) and data.get("type", None) == "tick":
+                        self._apply_tick(data)
+                        continue
+                    # a batch is answered with the responses to its requests, in the same order
+                    if isinstance(data, dict) and data.get("type", None) == "batch":
+                        self._use_epoch(data.get("epoch", None))
+                        responses += format_message({"type": "batch", "responses": [self.serve_request(request) for request in data.get("requests", [])]})
+                        continue
+                    responses += format_message(self.serve_request(data))
+                # while transactions wait on their fsync, every response after them waits too
+                if self.txn_unsynced:
+                    if responses:
+                        self.held.setdefault(conn, bytearray()).extend(responses)
+                    responses = b""
                 try:
-                    self.broker_conn.sendall(RPC_response)
-                except Exception:
+                    if responses or conn in writable:
+                        conn.send(responses)
+                except OSError:
                     pass
+            # the group is committed once it is full or has waited long enough
+            if self.txn_unsynced >= self.group_size or (self.group_deadline is not None and time.monotonic() >= self.group_deadline):
+                self.commit()
+            # every front-end keeps its own copy of the leaderboard, so they all hear about the net worths that changed
+            deltas = None
+            if time.monotonic() >= self.next_push and self.latest_epoch is not None:
+                self._use_epoch(self.latest_epoch)
+                deltas = self._net_worth_deltas()
+                self.next_push = time.monotonic() + NET_WORTH_PUSH_INTERVAL
+            if deltas:
+                message = format_message({"type": "net_worths", "Value": deltas})
+                for conn in self.broker_conns:
+                    try:
+                        conn.send(message)
+                    except OSError:
+                        pass
         
 if __name__ == "__main__":
     # ensure only a port is given
@@ -0,0 +1,174 @@
+# File: StockMarketAcceptor.py
+# Author: John Lee (jlee88@nd.edu) & David Simonneti (dsimone2@nd.edu)
+#
+# Description: Acceptor thread that runs the simulator's connection handshakes without blocking the publish loop
+
+import selectors
+import threading
+import time
+from collections import OrderedDict
+from StockMarketLib import parse_message, print_debug
+
+# a connection that has not finished its handshake in this long is dropped
+HANDSHAKE_TIMEOUT = 2 * 1e9
+# most handshakes in progress at once, further connections wait in the listen backlog
+MAX_HANDSHAKES = 256
+# largest handshake request accepted, anything bigger is not a well behaved client
+MAX_HANDSHAKE_BYTES = 64 * 1024
+
+class Handshake:
+    """State of a single connection, from accept() until its reply has been sent
+    """
+    __slots__ = ("conn", "addr", "deadline", "inbuf", "outbuf", "on_done")
+
+    def __init__(self, conn, addr, deadline):
+        self.conn = conn
+        self.addr = addr
+        self.deadline = deadline
+        self.inbuf = b""
+        self.outbuf = b""
+        # called with the connection once the reply is sent, when the connection outlives the handshake
+        self.on_done = None
+
+class HandshakeAcceptor(threading.Thread):
+    """Accepts connections on a listening socket and runs each handshake as a non-blocking state machine:
+    read one formatted request, pass it to handler, write back the reply, then close or hand over the connection.
+
+    handler(request, addr) runs on the acceptor thread and returns (reply bytes or None, on_done or None).
+    Connections are closed once their reply is sent, unless on_done is given, in which case it gets the (blocking) connection.
+    """
+    def __init__(self, listen_socket, handler, timeout=HANDSHAKE_TIMEOUT, max_handshakes=MAX_HANDSHAKES):
+        super().__init__(daemon=True)
+        self.listen_socket = listen_socket
+        self.handler = handler
+        self.timeout = int(timeout)
+        self.max_handshakes = max_handshakes
+        self.selector = selectors.DefaultSelector()
+        # handshakes in the order they started, which is also the order they time out in
+        self.pending = OrderedDict()
+        self.accepting = False
+        # how handshakes ended, reported with the name server updates
+        self.outcomes = {"completed": 0, "failed": 0, "timed out": 0}
+
+    def run(self):
+        self.listen_socket.setblocking(False)
+        self._resume_accepting()
+        while True:
+            # sleep until the oldest handshake would time out
+            timeout = None
+            if self.pending:
+                oldest = next(iter(self.pending.values()))
+                timeout = max(0, (oldest.deadline - time.monotonic_ns()) / 1e9)
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    self._accept()
+                elif mask & selectors.EVENT_READ:
+                    self._read(key.data)
+                else:
+                    self._write(key.data)
+            self._expire()
+
+    ##############
+    # Accept Cap #
+    ##############
+
+    def _resume_accepting(self):
+        if not self.accepting:
+            self.selector.register(self.listen_socket, selectors.EVENT_READ, None)
+            self.accepting = True
+
+    def _pause_accepting(self):
+        if self.accepting:
+            self.selector.unregister(self.listen_socket)
+            self.accepting = False
+
+    #########################
+    # Handshake State Steps #
+    #########################
+
+    def _accept(self):
+        """Takes every waiting connection, up to the handshake cap
+        """
+        while len(self.pending) < self.max_handshakes:
+            try:
+                conn, addr = self.listen_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print_debug("Accept failed", e)
+                return
+            conn.setblocking(False)
+            handshake = Handshake(conn, addr, time.monotonic_ns() + self.timeout)
+            self.pending[conn] = handshake
+            self.selector.register(conn, selectors.EVENT_READ, handshake)
+        # leave the rest in the listen backlog until a handshake finishes
+        self._pause_accepting()
+
+    def _read(self, handshake):
+        try:
+            data = handshake.conn.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._close(handshake, outcome="failed")
+            return
+        handshake.inbuf += data
+        try:
+            request, _ = parse_message(handshake.inbuf)
+        except ValueError:
+            self._close(handshake, outcome="failed")
+            return
+        if request is None:
+            if len(handshake.inbuf) > MAX_HANDSHAKE_BYTES:
+                self._close(handshake, outcome="failed")
+            return
+        try:
+            reply, handshake.on_done = self.handler(request, handshake.addr)
+        except Exception as e:
+            print_debug(f"Handshake from {handshake.addr} failed", e)
+            self._close(handshake, outcome="failed")
+            return
+        # a memoryview so partial sends of a large reply don't copy the rest of it each time
+        handshake.outbuf = memoryview(reply or b"")
+        self.selector.modify(handshake.conn, selectors.EVENT_WRITE, handshake)
+        self._write(handshake)
+
+    def _write(self, handshake):
+        if handshake.outbuf:
+            try:
+                sent = handshake.conn.send(handshake.outbuf)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self._close(handshake, outcome="failed")
+                return
+            handshake.outbuf = handshake.outbuf[sent:]
+            if handshake.outbuf:
+                return
+        self._close(handshake)
+
+    def _close(self, handshake, outcome="completed"):
+        """Ends a handshake, handing over its connection if it was successful and asked for it
+        """
+        self.selector.unregister(handshake.conn)
+        del self.pending[handshake.conn]
+        self.outcomes[outcome] += 1
+        if outcome == "completed" and handshake.on_done is not None:
+            handshake.conn.setblocking(True)
+            handshake.on_done(handshake.conn)
+        else:
+            handshake.conn.close()
+        self._resume_accepting()
+
+    def _expire(self):
+        """Drops every handshake that ran past its deadline
+        """
+        now = time.monotonic_ns()
+        while self.pending:
+            handshake = next(iter(self.pending.values()))
+            if handshake.deadline > now:
+                break
+            print_debug(f"Handshake from {handshake.addr} timed out.")
+            self._close(handshake, outcome="timed out")
@@ -0,0 +1,133 @@
+# File: StockMarketBarStore.py
+# Author: David Simonneti (dsimone2@nd.edu) & John Lee (jlee88@nd.edu)
+#
+# Description: Columnar binary cache of the historical minute bars stored in data/*.csv
+
+import csv
+import hashlib
+import json
+import os
+from datetime import datetime
+import numpy as np
+from StockMarketLib import print_debug
+
+# columns kept in the cache, in storage order
+BAR_FIELDS = ("timestamp", "open", "high", "low", "close")
+
+class BarStore:
+    """Memory-mapped store of historical minute bars, indexed by ticker and minute.
+
+    Every ticker's csv is converted once into a columnar .npy file in data/cache,
+    which is rebuilt only when the csv's modification time and hash change.
+    """
+    def __init__(self, tickers, data_dir="data"):
+        self.data_dir = data_dir
+        self.cache_dir = os.path.join(data_dir, "cache")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.tickers = list(tickers)
+        self.ticker_index = {t: i for i, t in enumerate(self.tickers)}
+        # one (len(BAR_FIELDS), minutes) array per ticker, backed by the cache file
+        self.columns = [self._load(t) for t in self.tickers]
+
+    #################
+    # Cache Methods #
+    #################
+
+    def _load(self, ticker):
+        """Memory-maps the cache for a ticker, converting its csv first if the cache is missing or stale
+        """
+        csv_path = os.path.join(self.data_dir, f"{ticker}.csv")
+        cache_path = os.path.join(self.cache_dir, f"{ticker}.npy")
+        meta_path = os.path.join(self.cache_dir, f"{ticker}.json")
+
+        stat = os.stat(csv_path)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except Exception:
+            meta = {}
+        # cheap check first, only hash the csv if its mtime or size moved
+        if not os.path.isfile(cache_path) or meta.get("mtime_ns") != stat.st_mtime_ns or meta.get("size") != stat.st_size:
+            digest = self._hash(csv_path)
+            if not os.path.isfile(cache_path) or meta.get("sha1") != digest:
+                self._convert(csv_path, cache_path)
+                print_debug(f"Bar cache rebuilt for {ticker}.")
+            meta = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha1": digest}
+            with open(meta_path + ".shadow", "w") as f:
+                json.dump(meta, f)
+            os.replace(meta_path + ".shadow", meta_path)
+        print_debug(f"Minute bars mapped for {ticker}.")
+        return np.load(cache_path, mmap_mode="r")
+
+    def _hash(self, path):
+        """Returns the sha1 digest of a file
+        """
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _convert(self, csv_path, cache_path):
+        """Converts a csv of minute bars into a columnar binary file
+        """
+        with open(csv_path) as csvfile:
+            reader = csv.DictReader(csvfile)
+            rows = [(datetime.fromisoformat(row["timestamp"]).timestamp(), float(row["open"]),
+                     float(row["high"]), float(row["low"]), float(row["close"])) for row in reader]
+        columns = np.ascontiguousarray(np.array(rows, dtype=np.float64).reshape(-1, len(BAR_FIELDS)).T)
+        # write through a shadow file so a concurrent reader never maps a partial cache
+        with open(cache_path + ".shadow", "wb") as f:
+            np.save(f, columns)
+        os.replace(cache_path + ".shadow", cache_path)
+
+    ##############
+    # Bar Lookup #
+    ##############
+
+    def num_minutes(self, ticker):
+        """Number of minute bars available for a ticker
+        """
+        return self.columns[self.ticker_index[ticker]].shape[1]
+
+    def column(self, ticker, field):
+        """Returns a read-only view over one column (see BAR_FIELDS) of a ticker's bars
+        """
+        return self.columns[self.ticker_index[ticker]][BAR_FIELDS.index(field)]
+
+    def bar(self, ticker, minute):
+        """Returns the (open, high, low, close) bar of a ticker at a minute index
+        """
+        columns = self.columns[self.ticker_index[ticker]]
+        return tuple(columns[1:, minute % columns.shape[1]].tolist())
+
+    def bars(self, minute):
+        """Returns an array with the (open, high, low, close) bar of every ticker at a minute index.
+        Tickers with fewer bars wrap around to their beginning.
+        """
+        return np.array([columns[1:, minute % columns.shape[1]] for columns in self.columns])
+
+    def minutes_between(self, start, end):
+        """Sorted timestamps of every minute in [start, end) that has a bar for at least one ticker
+        """
+        minutes = []
+        for columns in self.columns:
+            timestamps = columns[0]
+            lo, hi = np.searchsorted(timestamps, [start, end])
+            minutes.append(timestamps[lo:hi])
+        return np.unique(np.concatenate(minutes))
+
+    def bars_at(self, timestamp):
+        """Returns an array with the (open, high, low, close) bar of every ticker at a minute timestamp.
+        Tickers that did not trade in that minute stay flat at their last close.
+        """
+        bars = np.empty((len(self.columns), 4))
+        for i, columns in enumerate(self.columns):
+            index = np.searchsorted(columns[0], timestamp, side="right") - 1
+            if index >= 0 and columns[0, index] == timestamp:
+                bars[i] = columns[1:, index]
+            else:
+                # before a ticker's first bar, hold at its first open
+                bars[i] = columns[4, index] if index >= 0 else columns[1, 0]
+        return bars
@@ -1,38 +1,97 @@
 # File: StockMarketBroker.py
-# Author: David Simonneti (dsimone2@nd.edu) & John Lee (jlee88@nd.edu) 
-# 
+# Author: David Simonneti (dsimone2@nd.edu) & John Lee (jlee88@nd.edu)
+#
 # Description: Main Load Balancer/Broker server that redistributes tasks
 
+import hmac
+import os
 import socket
 import sys
 import time
 import json
-import select
-import random
-import signal
-from collections import deque 
-from StockMarketLib import format_message, receive_data, lookup_server, print_debug, VALID_TICKERS
+import resource
+import selectors
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from StockMarketFairQueue import FairQueue
+from StockMarketHashRing import HashRing
+from StockMarketLeaderboard import Leaderboard
+from StockMarketLib import BufferedConnection, PriceTable, decode_tick_entries, format_message, parse_packet, receive_packet, lookup_server, print_debug
+
+# how often the name server is updated and the leaderboard fully resynced, in seconds
+UPDATE_INTERVAL = 60
+# how long a leaderboard resync waits on the replicators before reporting the ones that did not answer, in seconds
+GATHER_DEADLINE = 5
+# ticks streamed to the replicators as changes between full snapshots of every price
+TICK_SNAPSHOT_INTERVAL = 100
+# rows in a leaderboard unless the client asks for some other number, and the most it may ask for
+LEADERBOARD_ROWS = 10
+MAX_LEADERBOARD_ROWS = 100
+# distinct leaderboard queries kept rendered for the current leaderboard version
+LEADERBOARD_CACHE_SIZE = 1024
+# how often a replicator that went down is reconnected to, in seconds
+RECONNECT_INTERVAL = 1
+# how long a reconnect may wait on the name server, and on each connection it tries, in seconds
+CONNECT_TIMEOUT = 5
+# threads that reconnect to replicators, so the event loop never waits on the name server or a connect
+CONNECT_THREADS = 4
+# most open files asked for when the system puts no limit on them
+MAX_OPEN_FILES = 65536
+# default number of requests each replicator may have in flight at once
+PIPELINE_WINDOW = 32
+# most requests sent to a replicator in a single batch message. No more than the window can be in flight,
+# so a bigger batch could never fill up
+BATCH_SIZE = PIPELINE_WINDOW
+# how long requests may wait for a batch to fill up before it is sent anyways, in seconds.
+# With no wait, batches hold whatever came in during one pass of the event loop
+BATCH_WINDOW = 0
+# where the broker keeps the chains of its hash ring, so a restart maps users the same way
+RING_FILE = "ring.json"
+# most user records moved between replicators by a single migration request
+MIGRATION_BATCH = 500
+# actions only the broker itself may send the replicators, clients sending them are turned away
+BROKER_ACTIONS = ("broker_leaderboard", "migrate_out", "migrate_in", "migrate_drop")
+# the operator account that may rebalance the replicators. Its password is read from this environment variable
+# when the broker starts, and rebalancing on request is turned off without it
+ADMIN_USERNAME = "admin"
+ADMIN_PASSWORD_ENV = "STOCKMARKET_ADMIN_PASSWORD"
+# how long a rebalance waits for the replicators it adds to be up, in seconds
+REBALANCE_CONNECT_DEADLINE = 10
 
 class StockMarketBroker:
-    def __init__(self, broker_name, num_chains):
+    def __init__(self, broker_name, num_chains, window=PIPELINE_WINDOW, port=0, frontends=1, batch_size=BATCH_SIZE, batch_window=BATCH_WINDOW):
         """Initializes the stock market broker, accepting connections from a randomly selected port.
-        
+
         Also opens a UDP connection to the name server
 
         Args:
             broker_Name (str): name of the broker
-            num_chains (int): how many chain replication servers will be connected
+            num_chains (int): how many chain replication servers will be connected, users are moved over if this changed
+            window     (int): how many requests each replicator may have in flight at once
+            port       (int): port to listen on, shared with the other front-ends on this host
+            frontends  (int): how many broker front-ends are serving clients on this host
+            batch_size   (int): most requests sent to a replicator in a single batch message
+            batch_window (float): how long requests may wait for a batch to fill up, in seconds
         """
-        
+
         # project name for this broker
         self.broker_name = broker_name
+        # every client is a socket, so allow as many open files as the system lets us
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (MAX_OPEN_FILES if hard == resource.RLIM_INFINITY else hard, hard))
+        except (ValueError, OSError):
+            # keep the limit we have, the broker just serves fewer clients at once
+            print_debug(f"Unable to raise the open file limit, keeping {soft}")
         # create socket
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # set 60 seconds timeout waiting for a connection, so we can update the name server
-        self.socket.settimeout(60)
+        # front-ends share the port, and the kernel spreads new clients between them
+        self.frontends = frontends
+        if frontends > 1:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         # try to bind to port
         try:
-            self.socket.bind((socket.gethostname(), 0))
+            self.socket.bind((socket.gethostname(), port))
         # error if port already in use
         except:
             print("Error: port in use")
@@ -40,150 +99,376 @@ class StockMarketBroker:
 
         self.port_number = self.socket.getsockname()[1]
         print_debug(f"Listening on port {self.port_number}")
-        
-        self.socket.listen()
-        # use a set to keep track of all open sockets - master socket is the first socket
-        self.socket_table = set([self.socket])
-        
-        # for users and the leaderboard
-        self.leaderboard = []
-        
-        # for stock info
-        self.latest_stock_info = None
+
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(False)
+        # every socket stays registered for as long as it is open, the listening socket is the only one without a connection
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+
+        # for users and the leaderboard, kept up to date by the net worths replicators push
+        self.leaderboard = Leaderboard()
+        # maps (top, offset, around_user) -> leaderboard response ready to send, for leaderboard_version only
+        self.leaderboard_cache = {}
+        self.leaderboard_version = None
+        # the leaderboard resync in progress, and how the last one went, see _update_leaderboard
+        self.gather = None
+        self.last_gather = None
+
+        # for stock info, the universe of tickers comes from the simulator
+        self.prices = None
+        # prices are streamed to the replicators once per tick, and requests name the tick (its epoch) they were priced at.
+        # maps ticker index -> price for the changes not streamed yet, and the epoch last streamed
+        self.tick_changes = {}
+        self.tick_epoch = None
+        self.ticks_streamed = 0
 
         # send information to name server
         self.ns_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.ns_socket.connect(("catalog.cse.nd.edu", 9097))
 
         # connect to simulator
-        self.stockmarketsim_sock = self.connect_to_server("stockmarketsim")
+        self.stockmarketsim_sock = self.connect_to_stockmarketsim()
 
         # used to set up replication servers
         # each 1 of n replication servers will handle about 1/n of client information/requests
-        # here we set up our connections to the replication servers
-        # num_chains is the total number of replication servers, chain number is the current id of the replication server
-        self.num_chains = num_chains
-        # maps chain number -> socket object
+        # users are mapped to replication servers by a consistent hash ring, which is kept across restarts
+        # chain number is the id of the replication server
+        saved_ring = HashRing.load(RING_FILE)
+        # users can only be moved while a single front-end routes requests, and front-ends have to share the ring
+        error = check_frontend_ring(saved_ring, num_chains, frontends)
+        if error is not None:
+            print(f"Error: {error}")
+            exit(1)
+        self.ring = saved_ring or HashRing(range(num_chains))
+        # a rebalance in progress, see start_rebalance
+        self.migration = None
+        self.admin_password = os.environ.get(ADMIN_PASSWORD_ENV, None)
+        # maps chain number -> connection, or None while the replicator is down
         self.chain_sockets = {}
-        # maps socket object -> chain number
+        # maps connection -> chain number
         self.chain_to_index = {}
-        # maps chain number -> a deque of pending client requests for that server
+        # maps chain number -> fair queue of pending requests for that server, per client connection
         # (pending requests can occur if the replication server crashed or multiple clients are trying to use the same server)
+        # requests the broker makes itself are queued under None, with a callback instead of a client connection
         self.pending_reqs = {}
-        for i in range(num_chains):
-            self.chain_sockets[i] = self.connect_to_server(f"chain-{i}")
-            self.chain_to_index[self.chain_sockets[i]] = i
-            self.pending_reqs[i] = deque()
-
-        # set of client connections with a current request - so that we only handle one client conn at a time
-        self.pending_conns = set()
-        # maps chain socket object -> client connection that is currently being handled on that server
+        # maps chain number -> request id -> (request, client connection) for the requests in flight on that server, oldest first
         self.name_to_conn = {}
-        # data structure used for measuring the fairness of the broker. maps client number to the number of requests serviced for that client
-        self.done = {}
-
-        # ensure we get one round of stock prices before we start 
-        while self.latest_stock_info == None:
-            status, data = receive_data(self.stockmarketsim_sock)
-            ## error reading from stock market sim
-            if data is None or status == 2:
-                # try to reconnect and go to next loop, since all data was out of date anyways
-                self.stockmarketsim_sock = self.connect_to_server("stockmarketsim")
-                continue
-            self.latest_stock_info = json.loads(data)
+        self.window = window
+        # queued requests are sent to each replicator in batches, see dispatch
+        self.batch_size = min(batch_size, window)
+        self.batch_window = batch_window
+        # maps chain number -> when its oldest request that is waiting on a batch was queued
+        self.batch_ready = {}
+        # every request forwarded to a replicator gets an id, which the replicator echoes in its response
+        self.next_request_id = 0
+        # replicators that are down are reconnected to on connector threads, see reconnect_chains.
+        # maps chain number -> future of the connection attempt in progress
+        self.connector = ThreadPoolExecutor(max_workers=CONNECT_THREADS)
+        self.connecting = {}
+        for i in self.ring.chains:
+            self._init_chain(i)
+
+        # keep track of how many requests the broker has handled
+        self.total_requests_handled = 0
+        # maps client connection -> "host:port" of the client, for reporting
+        self.clients = {}
+
+        # ensure we get one round of stock prices before we start
+        while not self.receive_stock_update():
+            pass
+        self.stockmarketsim_sock = self._add_stockmarketsim(self.stockmarketsim_sock)
+        self._stream_tick()
+
+        # update the leaderboard & name server now and every minute after
+        self.next_update = time.monotonic()
+        self.next_reconnect = time.monotonic() + RECONNECT_INTERVAL
+
+        # move users over if the number of chains changed. Without a saved ring this also
+        # gathers users that an older placement left on the wrong replicator
+        if frontends == 1 and (saved_ring is None or saved_ring.chains != list(range(num_chains))):
+            error = self.start_rebalance(range(num_chains), self._startup_rebalanced)
+            if error is not None:
+                print(f"Error: {error}")
+                exit(1)
 
-        # update the leaderboard & name server every minute 
-        signal.signal(signal.SIGALRM, self._update)
-        signal.setitimer(signal.ITIMER_REAL, .1, 60) # now and every 60 seconds after
-    
     ##################
     # Socket Methods #
     ##################
-    
-    def connect_to_server(self, server_type, max_attempts=100):
-        """ Connect to given server type on socket 
+
+    def connect_to_server(self, server_type, max_attempts=100, hello=None, lookup_timeout=None):
+        """ Connect to given server type on socket
         Args:
             server_type  (str): type of the server to connect to
             max_attempts (int): how many attempts will be made to connect to the server
+            hello       (dict): first message sent to the server, defaults to identifying as the broker
+            lookup_timeout (float): if given, each attempt looks the server up once, waiting this long on the name server
         """
         attempts = 0
         timeout = 1
+        sock = None
         while True:
-            # stop trying if we reached max attempts
-            if attempts >= max_attempts:
-                return None
             # try to lookup the server_type on the same project name
-            possible_servers = lookup_server(self.broker_name, server_type) 
+            if lookup_timeout is None:
+                possible_servers = lookup_server(self.broker_name, server_type)
+            else:
+                possible_servers = lookup_server(self.broker_name, server_type, max_attempts=1, timeout=lookup_timeout)
             # try and connect to each in order
             for server in possible_servers:
                 try:
                     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(5)
+                    sock.settimeout(CONNECT_TIMEOUT)
                     sock.connect((server["name"], server["port"]))
-                    sock.sendall(format_message({"type": "broker"}))
+                    sock.sendall(format_message(hello or {"type": "broker"}))
                     print_debug(f"Connected to server {server_type}")
                     break
                 except Exception:
+                    if sock is not None:
+                        sock.close()
                     sock = None
             # if we got a connection, we can stop trying!
             if sock != None:
                 break
+            # stop trying if we reached max attempts, without waiting for an attempt that will never be made
+            attempts += 1
+            if attempts >= max_attempts:
+                return None
             print(f"Unable to connect to server {server_type}, retrying in {timeout} seconds")
             time.sleep(timeout)
-            timeout *= 2 
-            attempts += 1
+            timeout *= 2
+        return sock
+
+    def connect_to_stockmarketsim(self):
+        """ Connect to the simulator, asking for its binary tick feed.
+        The simulator answers with the universe of tickers before the first tick.
+        """
+        while True:
+            sock = self.connect_to_server("stockmarketsim", hello={"type": "broker", "format": "binary"})
+            status, packet = receive_packet(sock)
+            try:
+                tickers = json.loads(packet)["tickers"]
+                break
+            except Exception:
+                print("Unable to get the universe of tickers from the simulator, reconnecting")
+                sock.close()
+        if self.prices is None or self.prices.tickers != tickers:
+            self.prices = PriceTable(tickers)
         return sock
-    
+
+    def connect_to_chain(self, index, max_attempts=100):
+        """ Connect to a replicator, telling it the universe of tickers our prices are ordered by
+        """
+        return self.connect_to_server(f"chain-{index}", max_attempts=max_attempts, hello=self._chain_hello())
+
+    def _chain_hello(self):
+        return {"type": "broker", "tickers": self.prices.tickers}
+
+    def start_chain_connect(self, index):
+        """Starts a single attempt to connect to a replicator on a connector thread, unless one is running.
+        The event loop picks the connection up in reconnect_chains
+        """
+        if index not in self.connecting:
+            self.connecting[index] = self.connector.submit(self.connect_to_server, f"chain-{index}", 1, self._chain_hello(), CONNECT_TIMEOUT)
+
+    def receive_stock_update(self):
+        """ Reads one binary tick from the simulator and applies it to our prices.
+        Only used while starting up, before the simulator connection joins the event loop.
+        Returns False after reconnecting if the simulator connection broke.
+        """
+        status, packet = receive_packet(self.stockmarketsim_sock)
+        if status == 0 and packet is not None and self.apply_stock_update(packet):
+            return True
+        # try to reconnect, since all data was out of date anyways
+        self.stockmarketsim_sock = self.connect_to_stockmarketsim()
+        return False
+
+    def apply_stock_update(self, packet):
+        """ Applies one binary tick from the simulator to our prices
+        """
+        try:
+            flags, seq, time_ns, entries = decode_tick_entries(packet)
+            # remember what changed for the replicators, snapshots mostly repeat prices they already have
+            prices = self.prices.prices
+            for index, price in entries:
+                if prices[index] != price:
+                    self.tick_changes[index] = price
+            self.prices.apply(entries, seq, time_ns)
+            return True
+        except ValueError as e:
+            print_debug(e)
+            return False
+
     def accept_new_connection(self):
-        """Accepts a new connection and adds it to the socket table.
+        """Accepts every waiting connection and registers it with the event loop.
         """
-        conn, addr = self.socket.accept()
-        conn.settimeout(60)
-        self.socket_table.add(conn)
-    
-    ##################
-    # Signal Handler #
-    ##################
-    
-    def _update(self, _, __):
-        """ Combined update handler
+        while True:
+            try:
+                conn, addr = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # most likely out of file descriptors, the connection waits in the backlog until one frees up
+                print_debug("Accept failed", e)
+                return
+            client = BufferedConnection(conn)
+            self.selector.register(conn, selectors.EVENT_READ, client)
+            self.clients[client] = f"{addr[0]}:{addr[1]}"
+
+    def _add_stockmarketsim(self, sock):
+        """Registers a (new) simulator connection with the event loop
+        """
+        sim = BufferedConnection(sock, parse_packet)
+        self.selector.register(sock, selectors.EVENT_READ, sim)
+        return sim
+
+    def _init_chain(self, index, max_attempts=100):
+        """Sets up the queues for a chain and connects to it
+        """
+        self.pending_reqs[index] = FairQueue()
+        self.name_to_conn[index] = OrderedDict()
+        self._add_chain(index, self.connect_to_chain(index, max_attempts=max_attempts))
+
+    def _remove_chain(self, index):
+        """Disconnects from a chain that left the ring, along with its queues.
+        Returns the (request, reply) pairs that were still queued for it
+        """
+        self.chain_down(index)
+        del self.chain_sockets[index]
+        del self.name_to_conn[index]
+        return [item for _, item in self.pending_reqs.pop(index).drain()]
+
+    def _add_chain(self, index, sock):
+        """Registers a (new) replicator connection with the event loop, or marks it down if sock is None
+        """
+        if sock is None:
+            self.chain_sockets[index] = None
+            return
+        chain = BufferedConnection(sock)
+        self.selector.register(sock, selectors.EVENT_READ, chain)
+        self.chain_sockets[index] = chain
+        self.chain_to_index[chain] = index
+        # the replicator starts from every price, the epochs streamed after build on it
+        if self.tick_epoch is not None:
+            self.send(chain, format_message({"type": "tick", "epoch": self.tick_epoch, "latest_prices": self.prices.tolist()}))
+
+    def send(self, conn, message):
+        """Queues a formatted message on a connection, watching it for writability until the message is out.
+        Returns False if the connection broke.
+        """
+        if conn.closed:
+            return False
+        try:
+            done = conn.send(message)
+        except OSError:
+            return False
+        if not done:
+            self.selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+        return True
+
+    def flush(self, conn):
+        """Writes out what is left of a connection's queued messages once it is writable again
+        """
+        try:
+            done = conn.flush()
+        except OSError:
+            done = True
+        if done and not conn.closed:
+            self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    def close(self, conn):
+        """Unregisters and closes a connection
+        """
+        if conn.closed:
+            return
+        self.selector.unregister(conn.sock)
+        conn.close()
+
+    ###########################
+    # Name Server/Leaderboard #
+    ###########################
+
+    def _update(self):
+        """ Combined update, run by the event loop every UPDATE_INTERVAL seconds
         """
         self._update_ns({"type" : "stockmarketbroker", "owner" : "dsimone2", "port" : self.port_number, "project" : self.broker_name})
         self._update_leaderboard()
 
     def _update_leaderboard(self):
-        ''' updates the leaderboard by polling all connected replicators for their user info.
+        ''' resyncs the leaderboard by polling every replicator for its user info at once.
+        The polls wait in each replicator's queue like any other request, and the gather ends when all of them
+        answered or GATHER_DEADLINE passes, see _leaderboard_response and _finish_gather
         '''
-        # snapshot of each ticker's price
-        prices = {}
-        for t in VALID_TICKERS:
-            prices[t] = self.latest_stock_info[t]
-        
-        # keep a dictionary mapping users to their net worth
-        users = {}
-        request = {"action": "broker_leaderboard", "latest_stock_info": self.latest_stock_info, "username": "broker", "password": "broker"}
-        for i in range(self.num_chains):
-            # get the socket conn
-            chain_socket = self.chain_sockets[i]
-            # if the replicator is busy, skip it for this update
-            if i in self.name_to_conn.keys():
+        if self.gather is not None:
+            return
+        start = time.monotonic()
+        self.gather = {"start": start, "deadline": start + GATHER_DEADLINE, "waiting": set(), "times": {}, "missed": []}
+        for i, chain in self.chain_sockets.items():
+            # a replicator that is down would only answer with a failure
+            if chain is None:
+                self.gather["missed"].append(i)
                 continue
-            # try to get the user information from the replicator
-            try:
-                chain_socket.sendall(format_message(request))
-                status, data = receive_data(chain_socket)
-            except Exception as e:
-                print(f"Unable to send request to database server to get leaderboard info")
-                continue
-            # and try to update our user information with the info from that replicator
-            try:
-                users = {**users, **data["Value"]}      
-            except:
-                pass
-        # sort the users by their net worth
-        self.leaderboard = sorted(list([ (username, users[username]) for username in users.keys()]), key = lambda x: x[1], reverse=True)
-        print_debug("Leaderboard Updated.")
-    
+            self.gather["waiting"].add(i)
+            request = {"action": "broker_leaderboard", "username": "broker", "password": "broker"}
+            self.start_request(i, request, lambda response, i=i, gather=self.gather: self._leaderboard_response(gather, i, response))
+        if not self.gather["waiting"]:
+            self._finish_gather()
+
+    def _leaderboard_response(self, gather, index, response):
+        ''' merges a replicator's user information into the leaderboard.
+        Answers that come in after the deadline are still merged, they are as fresh as the pushes before them
+        '''
+        try:
+            self._apply_net_worths(response["Value"])
+        except Exception:
+            pass
+        if gather is not self.gather:
+            return
+        gather["waiting"].discard(index)
+        # a replicator that crashed before answering fails the poll
+        if response.get("Success", False):
+            gather["times"][index] = time.monotonic() - gather["start"]
+        else:
+            gather["missed"].append(index)
+        if not gather["waiting"]:
+            self._finish_gather()
+
+    def _finish_gather(self):
+        ''' ends the leaderboard resync in progress, reporting how long it took and which replicators did not answer
+        '''
+        gather = self.gather
+        self.gather = None
+        missed = sorted(gather["missed"] + list(gather["waiting"]))
+        self.last_gather = {"seconds": round(time.monotonic() - gather["start"], 6), "missed": missed,
+                            "chains": {index: round(seconds, 6) for index, seconds in gather["times"].items()}}
+        print_debug(f"Leaderboard Updated from {len(gather['times'])} replicators in {self.last_gather['seconds'] * 1000:.1f} ms"
+                    + (f", no answer from chains {missed}" if missed else ""))
+
+    def _apply_net_worths(self, net_worths):
+        ''' updates the leaderboard with {username: net worth} from a replicator
+        '''
+        for username, net_worth in net_worths.items():
+            self.leaderboard.update(username, net_worth)
+
+    def _stream_tick(self):
+        ''' sends the prices that changed since the last epoch to every replicator, once per batch of ticks from the simulator.
+        An epoch is the simulator sequence number, its changes name the epoch they build on (base),
+        and every TICK_SNAPSHOT_INTERVAL epochs all prices are sent so a replicator that missed one catches up.
+        These are not requests, so they have no id and skip the queues
+        '''
+        if not self.tick_changes and self.tick_epoch is not None:
+            return
+        if self.tick_epoch is None or self.ticks_streamed % TICK_SNAPSHOT_INTERVAL == 0:
+            tick = {"type": "tick", "epoch": self.prices.seq, "latest_prices": self.prices.tolist()}
+        else:
+            tick = {"type": "tick", "epoch": self.prices.seq, "base": self.tick_epoch, "entries": list(self.tick_changes.items())}
+        self.tick_changes.clear()
+        self.tick_epoch = self.prices.seq
+        self.ticks_streamed += 1
+        message = format_message(tick)
+        for index, chain in list(self.chain_sockets.items()):
+            if chain is not None and not self.send(chain, message):
+                self.chain_down(index)
+
     def _update_ns(self, message):
         """Updates the name server with the current state
         """
@@ -192,106 +477,526 @@ class StockMarketBroker:
         print_debug("Name Server Updated.")
         # keep track of last name server update
         self.last_ns_update = time.time_ns()
-        
+
     ######################
     # Replicator Methods #
     ######################
 
-    def _get_leaderboard(self):
-        """reports the top 10 users
+    def _leaderboard_message(self, request):
+        """Leaderboard response ready to send. Responses are rendered once per leaderboard version,
+        so clients polling an unchanged leaderboard cost a dictionary lookup
         """
-        if self.leaderboard == []:
-            self._update_leaderboard(None, None)
-        # Top 10
-        lstring = "TOP 10\n" + "---------------\n"
-        try:
-            for i in range(10):
-                lstring += self.leaderboard[i][0] + ' | ' + str(round(self.leaderboard[i][1], 2)) + "\n"
-        except:
-            pass
+        if self.leaderboard_version != self.leaderboard.version:
+            self.leaderboard_cache.clear()
+            self.leaderboard_version = self.leaderboard.version
+        top = request.get("top", LEADERBOARD_ROWS)
+        offset = request.get("offset", 0)
+        around_user = request.get("around_user", None)
+        # validated before the cache, since False == 0 and 10.0 == 10 would otherwise share a key with valid queries
+        if type(top) is not int or not 0 < top <= MAX_LEADERBOARD_ROWS:
+            return format_message(self.json_resp(False, f"top must be an integer from 1 to {MAX_LEADERBOARD_ROWS}"))
+        if type(offset) is not int or offset < 0:
+            return format_message(self.json_resp(False, "offset must be a non-negative integer"))
+        if around_user is not None and type(around_user) is not str:
+            return format_message(self.json_resp(False, "around_user must be a username"))
+        key = (top, offset, around_user)
+        message = self.leaderboard_cache.get(key)
+        if message is None:
+            response = self._get_leaderboard(*key)
+            message = format_message(response)
+            # only answers are cached, errors are cheap to make again
+            if not response["Success"]:
+                return message
+            # a client walking through every page can't grow the cache without bound
+            if len(self.leaderboard_cache) >= LEADERBOARD_CACHE_SIZE:
+                self.leaderboard_cache.clear()
+            self.leaderboard_cache[key] = message
+        return message
+
+    def _get_leaderboard(self, top=LEADERBOARD_ROWS, offset=0, around_user=None):
+        """reports top users from rank offset on (0 is the richest), or the users ranked around around_user.
+        The query is validated by _leaderboard_message
+        """
+        if around_user is not None:
+            rank = self.leaderboard.rank(around_user)
+            if rank is None:
+                return self.json_resp(False, f"{around_user} is not on the leaderboard")
+            offset = max(0, rank - top // 2)
+        rows = [{"Rank": offset + i + 1, "Username": username, "Net Worth": round(net_worth, 2)}
+                for i, (username, net_worth) in enumerate(self.leaderboard.top(top, offset))]
+        # string representation & data repr
+        if offset == 0 and around_user is None:
+            lstring = f"TOP {top}\n"
+        else:
+            lstring = f"RANKS {offset + 1} - {offset + len(rows)}\n"
+        lstring += "---------------\n"
+        for row in rows:
+            lstring += row["Username"] + ' | ' + str(row["Net Worth"]) + "\n"
         print_debug("\n" + lstring)
-        return self.json_resp(True, lstring)
-        
-    def hash(self, string):
-        """returns an integer hash from an input string
-        """
-        if not isinstance(string, str):
-            raise TypeError("Key must be a string")
-        hash = 0
-        # loop over each character in the string
-        for character in string:
-            # add the ascii value of that character
-            hash += ord(character)
-        # return the integer hash of the string
-        return hash % 41
-    
+        return self.json_resp(True, {"Str": lstring, "Rows": rows, "Total": len(self.leaderboard), "Version": self.leaderboard.version})
+
     def json_resp(self, success, value):
         """Basic message fmt
         """
-        return {"Success": success, "Value": value}   
-    
-    def start_request(self, request, conn):
-        """Forwards job request to hashed replicator
+        return {"Success": success, "Value": value}
+
+    def handle_request(self, request, conn):
+        """Answers a client request, or queues it for the replicator its user hashes to
         """
         # if there is no username, we don't know which server to hash to
-        if request.get("username", None) == None:
-            return self.json_resp(False, "Username required to perform an action")
-        # if its a leaderboard request, then the broker handles it
+        if not isinstance(request, dict) or not isinstance(request.get("username", None), str):
+            self.send(conn, format_message(self.json_resp(False, "Username required to perform an action")))
+            return
+        # if its a leaderboard or stats request, then the broker handles it
         if request.get("action", None) == "leaderboard":
-            request["latest_stock_info"] = self.latest_stock_info
-            return self._get_leaderboard()
-        # peform the request the client submitted
-        # add current stock info to request
-        request["latest_stock_info"] = self.latest_stock_info
+            self.send(conn, self._leaderboard_message(request))
+            return
+        if request.get("action", None) == "stats":
+            self.send(conn, format_message(self.json_resp(True, self.scheduler_stats())))
+            return
+        if request.get("action", None) == "rebalance":
+            self.handle_rebalance(request, conn)
+            return
+        if request.get("action", None) in BROKER_ACTIONS:
+            self.send(conn, format_message(self.json_resp(False, f"{request['action']} can only be requested by the broker")))
+            return
         # see which replicator the client maps to
-        username_hash = self.hash(request["username"])
-        chain_num = (username_hash % self.num_chains)
-        chain_socket = self.chain_sockets[chain_num]
-        # if the replicator is busy, and the client isn't already in the request queue, we add it
-        if chain_num in self.name_to_conn.keys():
-            if (request, conn) not in self.pending_reqs[chain_num]:
-                self.pending_reqs[chain_num].append((request, conn))
-            return None
-        try:
-            chain_socket.sendall(format_message(request))
-        except Exception as e:
+        self.start_request(self.ring.lookup(request["username"]), request, conn)
+
+    def start_request(self, chain_num, request, reply):
+        """Queues a request for a replicator, to be forwarded with the next batch for it, see dispatch.
+        reply is the client connection the response goes to, or a callback for requests the broker makes itself
+        """
+        # the replicators only perform BROKER_ACTIONS for requests flagged as the broker's own
+        if callable(reply):
+            request["broker"] = True
+        else:
+            request.pop("broker", None)
+        self.pending_reqs[chain_num].push(None if callable(reply) else reply, (request, reply))
+        self.batch_ready.setdefault(chain_num, time.monotonic())
+
+    def dispatch(self):
+        """Forwards the batches that are ready, run by the event loop after every pass over the sockets.
+        A replicator's batch is ready once it is full, batch_size requests or as many as its window has room for,
+        or its oldest request has waited batch_window seconds
+        """
+        now = time.monotonic()
+        for chain_num, since in list(self.batch_ready.items()):
+            # the chain may have left the ring since
+            if chain_num not in self.pending_reqs:
+                del self.batch_ready[chain_num]
+                continue
+            room = self.window - len(self.name_to_conn[chain_num])
+            if now < since + self.batch_window and len(self.pending_reqs[chain_num]) < min(self.batch_size, room):
+                continue
+            del self.batch_ready[chain_num]
+            self.start_next_request(chain_num)
+
+    def start_next_request(self, chain_num):
+        """Forwards requests from the front of a replicator's queue until its window is full, in batches of
+        up to batch_size requests that are priced at the same epoch, all in a single write
+        """
+        chain = self.chain_sockets[chain_num]
+        in_flight = self.name_to_conn[chain_num]
+        pending = self.pending_reqs[chain_num]
+        if chain is None or not pending or len(in_flight) >= self.window:
+            return
+        started = []
+        messages = bytearray()
+        batch = []
+        while pending and len(in_flight) + len(started) < self.window:
+            _, (request, conn) = pending.pop()
+            # a user that is moving to another chain waits until the rebalance is done
+            if self.migration is not None and self.migration["sources"] is not None and not callable(conn) and self.migration["ring"].lookup(request["username"]) != chain_num:
+                self.migration["parked"].append((request, conn))
+                continue
+            request["id"] = self.next_request_id
+            self.next_request_id += 1
+            started.append((request, conn))
+            batch.append(request)
+            if len(batch) >= self.batch_size:
+                messages += self._format_batch(batch)
+                batch = []
+        if batch:
+            messages += self._format_batch(batch)
+        if not started:
+            return
+        if not self.send(chain, messages):
             print(f"Unable to send request to database server, adding to job queue")
-            chain_socket.close()
-            # if the replicator is down, try one time to reconnect, otherwise we add the request to the queue
-            chain_socket = self.connect_to_server(f"chain-{username_hash % self.num_chains}", max_attempts=1)
-            if chain_socket != None:
-                self.chain_sockets[chain_num] = chain_socket
-                self.chain_to_index[chain_socket] = (chain_num)
-            if (request, conn) not in self.pending_reqs[chain_num]:
-                self.pending_reqs[chain_num].append((request, conn))
-            return None
-        # return the replicator number that is servicing the request
-        return username_hash % self.num_chains
-        
-    def finalize_request(self, index):
-        """Asynchronously called when a replicator is done handling a client request
-        """
-        status, data = receive_data(self.chain_sockets[index])
-        if status == 0 and data:
-            response = data
+            # the requests go back to the front of the queue until the replicator is back
+            for request, conn in reversed(started):
+                pending.push_front(None if callable(conn) else conn, (request, conn))
+            self.chain_down(chain_num)
+            return
+        for request, conn in started:
+            in_flight[request["id"]] = (request, conn)
+
+    def _format_batch(self, requests):
+        """A batch message for a replicator, which performs the requests in order and answers with a batch of responses.
+        The replicator prices them at the latest epoch streamed to it
+        """
+        return format_message({"type": "batch", "epoch": self.tick_epoch, "requests": requests})
+
+    def finalize_request(self, index, response):
+        """Called when a replicator is done handling a client request
+        """
+        in_flight = self.name_to_conn[index]
+        # match the response up by its id, responses without one are for the oldest request
+        request_id = response.pop("id", None) if isinstance(response, dict) else None
+        if request_id in in_flight:
+            request, conn = in_flight.pop(request_id)
+        elif in_flight:
+            _, (request, conn) = in_flight.popitem(last=False)
         else:
+            return
+        self.total_requests_handled += 1
+        # every 1000 requests, print out how many requests have been handled along with the time
+        if (self.total_requests_handled % 1_000) == 0:
+            print(f"Time: {time.time_ns()} Requests handled: {self.total_requests_handled}")
+        if callable(conn):
+            conn(response)
+        else:
+            # if the client crashed, there is nothing we can do
+            self.send(conn, format_message(response))
+
+    def chain_down(self, index):
+        """Drops a replicator connection that broke. The requests it was handling fail,
+        and the event loop tries to reconnect to it every RECONNECT_INTERVAL seconds
+        """
+        chain = self.chain_sockets[index]
+        if chain is None:
+            return
+        self.close(chain)
+        del self.chain_to_index[chain]
+        self.chain_sockets[index] = None
+        while self.name_to_conn[index]:
             # if we get an incomplete response, something really bad has happened
-            response = self.json_resp(False, "The database server has crashed")
-        # try to send response to client
+            self.finalize_request(index, self.json_resp(False, "The database server has crashed"))
+
+    ###############
+    # Rebalancing #
+    ###############
+
+    def handle_rebalance(self, request, conn):
+        """Moves the hash ring onto the chains in request["chains"] (or chains 0 to request["num_chains"] - 1),
+        answering the client once every user is on its new chain. Only the admin may rebalance
+        """
+        password = request.get("password", None)
+        if (self.admin_password is None or request["username"] != ADMIN_USERNAME or not isinstance(password, str)
+                or not hmac.compare_digest(password.encode("utf-8"), self.admin_password.encode("utf-8"))):
+            self.send(conn, format_message(self.json_resp(False, "Rebalancing needs the admin username and password")))
+            return
+        # other front-ends would keep sending moving users' requests to their old chains
+        if self.frontends > 1:
+            self.send(conn, format_message(self.json_resp(False, "Rebalancing needs a single broker front-end")))
+            return
         try:
-            self.name_to_conn[index].sendall(format_message(response))
-        except Exception as e:
-            pass
-            # client crashed here, so nothing we can do
-        # used for debugging fairness of system
-        #self.done[self.name_to_conn[index]] = self.done.get(self.name_to_conn[index], 0) + 1
-        #print(len(self.done.keys()), [self.done[x] for x in self.done.keys()])
+            chains = request["chains"] if "chains" in request else range(int(request["num_chains"]))
+            chains = [int(c) for c in chains]
+        except Exception:
+            self.send(conn, format_message(self.json_resp(False, "chains must be a list of chain numbers, or num_chains a number")))
+            return
+        error = self.start_rebalance(chains, lambda response: self.send(conn, format_message(response)))
+        if error is not None:
+            self.send(conn, format_message(self.json_resp(False, error)))
+
+    def start_rebalance(self, chains, done):
+        """Starts moving users onto a new ring of chains. Every chain streams the records of the users
+        it no longer owns to their new chains in batches, while requests for those users wait.
+        done(response) is called once the new ring is in place. Returns an error message if the rebalance can't start.
+        """
+        if self.migration is not None:
+            return "A rebalance is already in progress"
+        try:
+            ring = HashRing(chains, self.ring.vnodes)
+        except ValueError as e:
+            return str(e)
+        # new chains have to be up before anything is moved to them. They are connected to like chains that went down,
+        # and the users start moving once they are all up, see _rebalance_connected
+        added = [index for index in ring.chains if index not in self.chain_sockets]
+        for index in added:
+            self.pending_reqs[index] = FairQueue()
+            self.name_to_conn[index] = OrderedDict()
+            self.chain_sockets[index] = None
+            self.start_chain_connect(index)
+        # sources is None until the users start moving
+        self.migration = {"ring": ring, "sources": None, "added": added, "moved": 0, "parked": [], "done": done,
+                          "start": time.time(), "connect_deadline": time.monotonic() + REBALANCE_CONNECT_DEADLINE}
+        self._rebalance_connected()
+        return None
+
+    def _rebalance_connected(self):
+        """Starts moving users once every chain the rebalance adds is connected,
+        or gives up on the rebalance if one is still down after REBALANCE_CONNECT_DEADLINE
+        """
+        migration = self.migration
+        if migration is None or migration["sources"] is not None:
+            return
+        down = [index for index in migration["added"] if self.chain_sockets[index] is None]
+        if down:
+            if time.monotonic() < migration["connect_deadline"]:
+                return
+            self.migration = None
+            for index in migration["added"]:
+                self._remove_chain(index)
+            migration["done"](self.json_resp(False, f"Unable to connect to chain-{down[0]}"))
+            return
+        print(f"Rebalancing from chains {self.ring.chains} to {migration['ring'].chains}")
+        migration["sources"] = set(self.chain_sockets)
+        for source in list(migration["sources"]):
+            self._migrate_batch(source)
 
+    def _startup_rebalanced(self, response):
+        """Called once the rebalance the broker started with is done, the broker can't run on a ring it could not move to
+        """
+        if not response["Success"]:
+            print(f"Error: {response['Value']}")
+            exit(1)
+
+    def _migrate_batch(self, source):
+        """Asks a chain for the next batch of user records it no longer owns under the new ring
+        """
+        request = {"action": "migrate_out", "username": "broker", "password": "broker",
+                   "ring": self.migration["ring"].to_json(), "limit": MIGRATION_BATCH}
+        self.start_request(source, request, lambda response: self._migrate_records(source, response))
+
+    def _migrate_records(self, source, response):
+        """Sends a batch of records from a chain on to the chains that own them now
+        """
+        records = response.get("Value", None) if response.get("Success", False) else None
+        if records is None:
+            # the chain failed, try again, since its users can't be served until they have moved
+            print(f"Migration from chain-{source} failed, retrying: {response.get('Value', None)}")
+            self._migrate_batch(source)
+            return
+        if records == []:
+            self.migration["sources"].discard(source)
+            if not self.migration["sources"]:
+                self._finish_rebalance()
+            return
+        destinations = {}
+        for record in records:
+            destinations.setdefault(self.migration["ring"].lookup(record["username"]), []).append(record)
+        # the source only drops its copies once every destination has stored them
+        waiting = {"count": len(destinations), "failed": False}
+        usernames = [record["username"] for record in records]
+        for destination, batch in destinations.items():
+            request = {"action": "migrate_in", "username": "broker", "password": "broker", "records": batch}
+            self.start_request(destination, request, lambda response: self._migrate_stored(source, usernames, waiting, response))
+
+    def _migrate_stored(self, source, usernames, waiting, response):
+        """Called as each destination stores its part of a batch, drops the batch from the source once all have
+        """
+        if not response.get("Success", False):
+            print(f"Migration into a chain failed: {response.get('Value', None)}")
+            waiting["failed"] = True
+        waiting["count"] -= 1
+        if waiting["count"] != 0:
+            return
+        if waiting["failed"]:
+            # the batch is still on the source, so it is sent again, storing records is idempotent
+            self._migrate_batch(source)
+            return
+        request = {"action": "migrate_drop", "username": "broker", "password": "broker", "usernames": usernames}
+        def dropped(response):
+            if response.get("Success", False):
+                self.migration["moved"] += len(usernames)
+            self._migrate_batch(source)
+        self.start_request(source, request, dropped)
+
+    def _finish_rebalance(self):
+        """Switches over to the new ring, and lets the parked requests through
+        """
+        migration = self.migration
+        self.migration = None
+        old_chains = self.ring.chains
+        self.ring = migration["ring"]
+        self.ring.save(RING_FILE)
+        # requests that were parked go first, then anything still queued, which may be queued on the wrong chain now
+        requeue = [(None, item) for item in migration["parked"]]
+        for index in old_chains:
+            items = self._remove_chain(index) if index not in self.ring.chains else [item for _, item in self.pending_reqs[index].drain()]
+            requeue += [(index, item) for item in items]
+        for index, (request, conn) in requeue:
+            if not callable(conn):
+                if conn.closed:
+                    continue
+                self.start_request(self.ring.lookup(request["username"]), request, conn)
+            # the broker's own requests stay on their chain, unless it is gone
+            elif index in self.pending_reqs:
+                self.start_request(index, request, conn)
+        summary = f"Moved {migration['moved']} users onto chains {self.ring.chains} in {time.time() - migration['start']:.2f} seconds"
+        print(summary)
+        migration["done"](self.json_resp(True, summary))
+
+    def scheduler_stats(self):
+        """Reports how many requests each client has had served, and how many are queued for each replicator
+        """
+        served = {}
+        for pending in self.pending_reqs.values():
+            for conn, count in pending.served.items():
+                client = self.clients.get(conn, "broker")
+                served[client] = served.get(client, 0) + count
+        return {"served": served, "queued": {index: len(pending) for index, pending in self.pending_reqs.items()}, "leaderboard_gather": self.last_gather}
+
+    def reconnect_chains(self):
+        """Adds the replicator connections that came up since the last call, and starts another attempt
+        for every replicator that is still down. Attempts run on the connector threads, so the event loop
+        never waits on the name server or a connect
+        """
+        for index, attempt in list(self.connecting.items()):
+            if not attempt.done():
+                continue
+            del self.connecting[index]
+            sock = attempt.result()
+            if sock is None:
+                continue
+            # the chain may have left the ring, or come back some other way, while we were connecting
+            if self.chain_sockets.get(index, False) is not None:
+                sock.close()
+                continue
+            self._add_chain(index, sock)
+            if self.pending_reqs[index]:
+                self.batch_ready.setdefault(index, time.monotonic())
+        for index, chain in self.chain_sockets.items():
+            if chain is None:
+                self.start_chain_connect(index)
+        # a rebalance may be waiting on the chains it adds
+        self._rebalance_connected()
+
+    ##############
+    # Event Loop #
+    ##############
+
+    def run(self):
+        """Serves clients, replicators and the simulator until the process is killed.
+        Every socket is registered once, so each event costs the same no matter how many connections are open.
+        """
+        while True:
+            now = time.monotonic()
+            if now >= self.next_update:
+                self._update()
+                self.next_update = now + UPDATE_INTERVAL
+            if now >= self.next_reconnect:
+                self.reconnect_chains()
+                self.next_reconnect = now + RECONNECT_INTERVAL
+            if self.gather is not None and now >= self.gather["deadline"]:
+                self._finish_gather()
+            # wait until the next housekeeping or batch at the latest
+            next_event = min(self.next_update, self.next_reconnect)
+            if self.batch_ready:
+                next_event = min(next_event, min(self.batch_ready.values()) + self.batch_window)
+            if self.gather is not None:
+                next_event = min(next_event, self.gather["deadline"])
+            timeout = max(0, next_event - time.monotonic())
+            for key, mask in self.selector.select(timeout):
+                conn = key.data
+                # the listening socket is the only one registered without a connection
+                if conn is None:
+                    self.accept_new_connection()
+                    continue
+                # a connection can be closed by an earlier event in the same batch
+                if conn.closed:
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self.flush(conn)
+                if mask & selectors.EVENT_READ:
+                    self.handle_readable(conn)
+            # everything queued during this pass goes out together
+            self.dispatch()
+
+    def handle_readable(self, conn):
+        """Reads from a connection that has data, dispatching on what is on the other end
+        """
+        try:
+            messages = conn.read()
+        except ValueError as e:
+            # the stream can't be resynchronized after a badly formatted message
+            self.send(conn, format_message(self.json_resp(False, str(e))))
+            messages = None
+        # new stock information available
+        if conn is self.stockmarketsim_sock:
+            if messages is None:
+                # try to reconnect, since all data was out of date anyways
+                self.close(conn)
+                self.stockmarketsim_sock = self._add_stockmarketsim(self.connect_to_stockmarketsim())
+                # a restarted simulator counts epochs from the start again, so the replicators get every price
+                self.tick_epoch = None
+                return
+            for packet in messages:
+                self.apply_stock_update(packet)
+            self._stream_tick()
+        # a replicator has a response for us
+        elif conn in self.chain_to_index:
+            index = self.chain_to_index[conn]
+            for response in messages or []:
+                # finishing a rebalance can remove this chain part way through
+                if conn.closed:
+                    return
+                # net worths the replicator pushed on its own are not responses
+                if isinstance(response, dict) and response.get("type", None) == "net_worths":
+                    self._apply_net_worths(response["Value"])
+                    continue
+                if isinstance(response, dict) and response.get("type", None) == "batch":
+                    for item in response.get("responses", []):
+                        self.finalize_request(index, item)
+                        # a response callback can finish a rebalance, which removes this chain
+                        if conn.closed:
+                            return
+                    continue
+                self.finalize_request(index, response)
+            if conn.closed:
+                return
+            if messages is None:
+                self.chain_down(index)
+            elif self.pending_reqs[index]:
+                # the window has room again, the requests waiting for this replicator go out with the next batch
+                self.batch_ready.setdefault(index, time.monotonic())
+        # otherwise a client sent us requests
+        else:
+            # if client connection was broken or closed, forget about it and whatever it still had queued
+            if messages is None:
+                self.close(conn)
+                del self.clients[conn]
+                for pending in self.pending_reqs.values():
+                    pending.cancel(conn)
+                return
+            for request in messages:
+                self.handle_request(request, conn)
+
+
+def check_frontend_ring(saved_ring, num_chains, frontends):
+    """Several front-ends only start from a saved ring of num_chains chains, since users can only be moved,
+    and a ring saved, by a single front-end. Without one, users an older placement left behind would be unreachable.
+    Returns an error message if the front-ends can't start
+    """
+    if frontends == 1:
+        return None
+    if saved_ring is None:
+        return f"no {RING_FILE} was saved, start a single front-end first to place the users on the {num_chains} replicators"
+    if saved_ring.chains != list(range(num_chains)):
+        return f"the replicators changed from {saved_ring.chains}, start a single front-end to move users over first"
+    return None
+
+def start_frontends(frontends):
+    """Forks the broker into frontends processes that share a listening port.
+    Returns the port and the socket reserving it, in the parent and in every child
+    """
+    # reserve a port that every front-end can bind to
+    reserve = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    reserve.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    reserve.bind((socket.gethostname(), 0))
+    port = reserve.getsockname()[1]
+    # each front-end has its own connections to the simulator and the replicators, so they are forked before any are made
+    for _ in range(frontends - 1):
+        if os.fork() == 0:
+            break
+    return port, reserve
 
 def main():
     # ensure only a port is given
-    if len(sys.argv) != 3:
-        print("Error: please enter project name and number of replicators as the arguments")
+    if len(sys.argv) not in (3, 4, 5):
+        print("Error: please enter project name and number of replicators as the arguments, optionally followed by the pipeline window and the number of front-ends")
         exit(1)
 
     try:
@@ -300,106 +1005,33 @@ def main():
         print("Error: number of replicators must be an integer")
         exit(1)
 
-    server = StockMarketBroker(sys.argv[1], num_chains)
-    # keep track of how many requests the broker has handled
-    total_requests_handled = 0
-    while True:
-        # use select to return a list of sockets ready for reading
-        # wait up to 5 seconds for an incoming connection
-        readable, _, _ = select.select(list(server.socket_table) + [server.stockmarketsim_sock] + list([server.chain_sockets[x] for x in server.name_to_conn.keys()]), [], [], 5)
-        # if no sockets are readable, try again
-        if readable == []:
-            continue
-        # if the master socket is in the readable list, give it priority and accept the new incomming client
-        if server.socket in readable:
-            server.accept_new_connection()
-            readable.remove(server.socket)
-        # new stock information available
-        if server.stockmarketsim_sock in readable:
-            status, data = receive_data(server.stockmarketsim_sock)
-            ## error reading from stock market sim
-            if data is None or status == 2:
-                # try to reconnect and go to next loop, since all data was out of date anyways
-                server.stockmarketsim_sock = server.connect_to_server("stockmarketsim")
-                continue
-            server.latest_stock_info = json.loads(data)
-            readable.remove(server.stockmarketsim_sock)
-        # otherwise we have at least one client connection with data available
-        # handle all pendings reads before performing select again
-        while len(readable) > 0:
-            # every 1000 requests, print out how many requests have been handled along with the time
-            if (total_requests_handled % 1_000) == 0:
-                print(f"Time: {time.time_ns()} Requests handled: {total_requests_handled}")
-            # randomly pick a client to service
-            conn = random.choice(readable)
-            readable.remove(conn)
-            # if the client already has a request pending, ignore it
-            if conn in server.pending_conns:
-                continue
-            # if a replicator has a response for us
-            if conn in [server.chain_sockets[x] for x in server.name_to_conn.keys()]:
-                total_requests_handled += 1
-                # get the replicator number
-                index = server.chain_to_index[conn]
-                # finalize the request
-                server.finalize_request(index)
-                # clean up data structures
-                server.pending_conns.remove(server.name_to_conn[index])
-                del server.name_to_conn[index]
-                # look into the waiting queue for the replicator and see if we can start another request quickly
-                to_try = [x for x in server.pending_reqs[index]]
-                for request, attempted_conn in to_try:
-                    # only try to service requests for the replicator that just freed up
-                    chain_sock = server.chain_sockets[server.hash(request["username"]) % server.num_chains]
-                    if chain_sock != conn:
-                        continue
-                    chain_servicer = server.start_request(request, attempted_conn)
-                    # if we successfully started it, clean up data structures 
-                    if chain_servicer != None:
-                        server.name_to_conn[chain_servicer] = attempted_conn
-                        server.pending_conns.add(attempted_conn)
-                        server.pending_reqs[index].remove((request, attempted_conn))
-                continue
-            # read a request, getting status (1 for error on read, 0 for successful reading), and the request
-            status, request = receive_data(conn)
-            if status != 0:
-                # send back error that occured
-                error_msg = server.json_resp(False, request)
-                try:
-                    conn.send(format_message(error_msg))
-                except Exception:
-                    pass
-                continue
-            # if client connection was broken or closed, go back to waiting for a new connection
-            if not request or request == {}:
-                conn.close()
-                server.socket_table.remove(conn)
-                continue
-            # if the request is not a leaderboard request, a replicator handles it. Otherwise, the broker handles it
-            if request.get("action", None) != "leaderboard":
-                # attempt to start the request
-                server.pending_conns.add(conn)
-                chain_servicer = server.start_request(request, conn)
-                if chain_servicer != None:
-                    server.name_to_conn[chain_servicer] = conn
-            else:
-                try:
-                    conn.sendall(format_message(server.start_request(request, conn)))
-                except Exception:
-                    pass
-        # at the end of every cycle, try and start any pending request at the front of each queue for each replicator
-        for key in server.pending_reqs.keys():
-            if server.chain_sockets[key] in server.name_to_conn.keys() or len(server.pending_reqs[key]) == 0:
-                continue
-            # get the request off the top of the queue
-            request, attempted_conn = server.pending_reqs[key][0]
-            chain_sock = server.chain_sockets[server.hash(request["username"]) % server.num_chains]
-            chain_servicer = server.start_request(request, attempted_conn)
-            if chain_servicer != None:
-                server.name_to_conn[chain_servicer] = attempted_conn
-                server.pending_conns.add(attempted_conn)
-                server.pending_reqs[key].remove((request, attempted_conn))
+    try:
+        window = int(sys.argv[3]) if len(sys.argv) >= 4 else PIPELINE_WINDOW
+    except Exception:
+        print("Error: pipeline window must be an integer")
+        exit(1)
+
+    try:
+        frontends = int(sys.argv[4]) if len(sys.argv) == 5 else 1
+        assert frontends >= 1
+    except Exception:
+        print("Error: number of front-ends must be a positive integer")
+        exit(1)
+
+    if frontends > 1:
+        # checked before forking, so it is only reported once
+        error = check_frontend_ring(HashRing.load(RING_FILE), num_chains, frontends)
+        if error is not None:
+            print(f"Error: {error}")
+            exit(1)
+        port, reserve = start_frontends(frontends)
+        server = StockMarketBroker(sys.argv[1], num_chains, window, port, frontends)
+        # the front-ends' own sockets hold the port from here on
+        reserve.close()
+    else:
+        server = StockMarketBroker(sys.argv[1], num_chains, window)
+    server.run()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
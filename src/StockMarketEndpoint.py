@@ -6,16 +6,21 @@
 import socket, json, time
 import random
 import threading
-from StockMarketLib import format_message, receive_data, lookup_server, SUBSCRIBE_TIMEOUT, print_debug
+from StockMarketLib import decode_tick, format_message, receive_data, lookup_server, SUBSCRIBE_TIMEOUT, VALID_TICKERS, print_debug
 
 class StockMarketEndpoint:
     """API Endpoint for a user to connect to the broker/simulator with
     """
 
-    def __init__(self, name, username, password):
+    def __init__(self, name, username, password, feed_format="json"):
+        """feed_format (str): format of the simulator's price feed, "json" or the compact "binary" packets
+        """
         self.name = name
         self.username = username
         self.password = password
+        self.feed_format = feed_format
+        # universe of tickers, the simulator tells us the real one when we subscribe
+        self.tickers = VALID_TICKERS
         
         # connect to broker & simulator
         self.connect_to_broker()
@@ -38,6 +43,8 @@ class StockMarketEndpoint:
         while True:
             # lookup all brokers with the right name and type
             possible_brokers = lookup_server(self.name, "stockmarketbroker")
+            # spread clients over the broker front-ends
+            random.shuffle(possible_brokers)
             # try to connect to each server
             for broker in possible_brokers:
                 try:
@@ -59,11 +66,13 @@ class StockMarketEndpoint:
     def subscribe_to_simulator(self, resub = True):
         """Subscribes to the simulator using a TCP
         """
-        # keep track of timeouts - exponentially increase by a factor of 2 each failed attempt
-        self.info_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.info_sock.bind((socket.gethostname(), 0))
-        self.info_sock.settimeout(5)
+        # the updates socket is bound once, so renewals keep the address the simulator already has subscribed
+        if not resub:
+            self.info_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.info_sock.bind((socket.gethostname(), 0))
+            self.info_sock.settimeout(5)
         sock_info = self.info_sock.getsockname()
+        # keep track of timeouts - exponentially increase by a factor of 2 each failed attempt
         timeout = 1
         while True:
             # lookup all brokers with the right name and type
@@ -75,8 +84,15 @@ class StockMarketEndpoint:
                     # print_debug(f"Trying to subscribe to {sim}")
                     self.sim_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                     self.sim_socket.connect((sim["name"], sim["port"]))
-                    self.sim_socket.sendall(format_message({"hostname": sock_info[0], "port": sock_info[1], "resub": resub}))
+                    self.sim_socket.sendall(format_message({"hostname": sock_info[0], "port": sock_info[1], "resub": resub, "format": self.feed_format}))
+                    # the first subscription is answered with the universe of tickers
+                    if not resub:
+                        status, reply = receive_data(self.sim_socket)
+                        if status == 0 and reply:
+                            self.tickers = reply["tickers"]
                     self.sim_socket.close()
+                    # remember the simulator for history queries
+                    self.sim_address = (sim["name"], sim["port"])
                     self.last_sub_time = time.time_ns()
                     print_debug("Resubscribed to StockMarketSim.")
                     # if we are successful, we can return with a complete connection
@@ -139,18 +155,66 @@ class StockMarketEndpoint:
 
     def async_get_stock_update(self):
         """Recieve the last stock update asyncronously, and if data is missed, ignore.
+        Updates only carry the tickers that changed, so they are merged into the prices we already have.
         Recv is blocking, so other threads can run while blocking.
         """
         while True:
             if (time.time_ns() - self.last_sub_time) > SUBSCRIBE_TIMEOUT * random.uniform(.8, .9):
                 self.subscribe_to_simulator()
             try:
-                self.recent_price = json.loads(self.info_sock.recv(1024))
+                data = self.info_sock.recv(65535)
+                if self.feed_format == "binary":
+                    update = decode_tick(data, self.tickers)
+                else:
+                    update = json.loads(data)
+                seq = update.get("seq", None)
+                last_seq = self.recent_price.get("seq", None)
+                if seq is not None and last_seq is not None:
+                    # late datagrams are older than what we have, unless the simulator restarted and sent a snapshot
+                    if seq < last_seq and not update.get("snapshot", False):
+                        continue
+                    # we dropped at least one datagram, fill the gap from the simulator's history
+                    if seq > last_seq + 1:
+                        for tick in self.get_history(since=last_seq + 1):
+                            if tick["seq"] < seq:
+                                self.recent_price = {**self.recent_price, **tick}
+                # swap in a new dictionary so readers never see a half merged update
+                self.recent_price = {**self.recent_price, **update}
             except Exception as e:
                 
                 print_debug("Could not get data", e)
                 pass
 
+    def get_history(self, last=100, since=None, tickers=None):
+        """Retrieves recent ticks from the simulator, oldest first, in the same form as get_stock_update
+        
+        last      (int): number of most recent ticks to get
+        since     (int): get every tick from this sequence number on instead
+        tickers  (list): only include these tickers, defaults to all of them
+        """
+        request = {"type": "history", "last": last}
+        if since is not None:
+            request["since"] = since
+        if tickers is not None:
+            request["tickers"] = tickers
+        try:
+            sock = socket.create_connection(self.sim_address, timeout=5)
+            sock.sendall(format_message(request))
+            status, resp = receive_data(sock)
+            sock.close()
+        except Exception as e:
+            print_debug("Could not get history", e)
+            return []
+        if status != 0 or not resp or resp['Success'] == False:
+            return []
+        history = resp['Value']
+        ticks = []
+        for seq, time_ns, prices in zip(history["seqs"], history["times"], history["prices"]):
+            tick = {"type": "stockmarketsimupdate", "time": time_ns, "seq": seq}
+            tick.update(zip(history["tickers"], prices))
+            ticks.append(tick)
+        return ticks
+
     #############
     # API Calls #
     #############
@@ -186,10 +250,13 @@ class StockMarketEndpoint:
         resp = self.send_request_to_broker(request)
         return resp
     
-    def get_leaderboard(self):
-        """Retrieves leaderboard of players
+    def get_leaderboard(self, top=10, offset=0, around_user=None):
+        """Retrieves leaderboard of players, top players from rank offset on or the players ranked around around_user.
+        Returns {"Str", "Rows", "Total", "Version"}, where each row is {"Rank", "Username", "Net Worth"}
         """
-        request = {"action": "leaderboard", "username": self.username, "password": self.password}
+        request = {"action": "leaderboard", "username": self.username, "password": self.password, "top": top, "offset": offset}
+        if around_user is not None:
+            request["around_user"] = around_user
         resp = self.send_request_to_broker(request)
         if resp['Success'] == False:
             raise Exception(resp['Value'])
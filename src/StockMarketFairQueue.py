@@ -0,0 +1,117 @@
+# File: StockMarketFairQueue.py
+# Author: David Simonneti (dsimone2@nd.edu) & John Lee (jlee88@nd.edu)
+#
+# Description: Deficit round robin queue the broker uses to share each replicator fairly between clients
+
+from collections import deque
+
+# requests a client may have served per turn of the round robin
+FAIR_QUANTUM = 1
+
+class Flow:
+    """The queued requests of a single client
+    """
+    __slots__ = ("key", "items", "deficit", "active")
+
+    def __init__(self, key):
+        self.key = key
+        self.items = deque()
+        self.deficit = 0
+        # whether the flow is in the round robin, a cancelled flow is left there and skipped
+        self.active = False
+
+class FairQueue:
+    """Requests queued per client, served by deficit round robin so a client
+    that floods a replicator can't starve the others waiting for it.
+
+    push, pop and cancel are O(1) (amortized), and the number of requests served per client is kept in served.
+    cost(item) is how much of a client's quantum a request uses, every request costs 1 by default.
+    """
+    def __init__(self, quantum=FAIR_QUANTUM, cost=None):
+        self.quantum = quantum
+        self.cost = cost or (lambda item: 1)
+        # maps client key -> flow
+        self.flows = {}
+        # flows with requests waiting, in round robin order
+        self.active = deque()
+        # maps client key -> number of requests served
+        self.served = {}
+        self.size = 0
+
+    def push(self, key, item):
+        """Queues item at the back of key's requests
+        """
+        flow = self._flow(key)
+        flow.items.append(item)
+        self.size += 1
+
+    def push_front(self, key, item):
+        """Puts item back at the front of key's requests, for requests that could not be sent
+        """
+        flow = self._flow(key)
+        flow.items.appendleft(item)
+        self.size += 1
+
+    def pop(self):
+        """Removes and returns (key, item) of the next request to serve, or None if nothing is queued
+        """
+        while self.active:
+            flow = self.active[0]
+            # a cancelled flow is only dropped once it comes around
+            if self.flows.get(flow.key) is not flow:
+                self.active.popleft()
+                continue
+            cost = self.cost(flow.items[0])
+            if flow.deficit < cost:
+                # the flow used up its turn, top it up and move on to the next one
+                flow.deficit += self.quantum
+                self.active.rotate(-1)
+                continue
+            flow.deficit -= cost
+            item = flow.items.popleft()
+            self.size -= 1
+            self.served[flow.key] = self.served.get(flow.key, 0) + 1
+            if not flow.items:
+                # an idle flow does not bank credit for later
+                flow.deficit = 0
+                flow.active = False
+                self.active.popleft()
+            return flow.key, item
+        return None
+
+    def cancel(self, key):
+        """Drops every request queued for key, and forgets about it. Returns the dropped requests
+        """
+        self.served.pop(key, None)
+        flow = self.flows.pop(key, None)
+        if flow is None:
+            return []
+        self.size -= len(flow.items)
+        return list(flow.items)
+
+    def drain(self):
+        """Removes and returns (key, item) of every queued request, each client's requests in order
+        """
+        items = []
+        for flow in self.flows.values():
+            items.extend((flow.key, item) for item in flow.items)
+            flow.items.clear()
+            flow.deficit = 0
+            flow.active = False
+        self.active.clear()
+        self.size = 0
+        return items
+
+    def _flow(self, key):
+        """Gets key's flow, adding it to the round robin if it had nothing queued
+        """
+        flow = self.flows.get(key)
+        if flow is None:
+            flow = self.flows[key] = Flow(key)
+        if not flow.active:
+            flow.active = True
+            self.active.append(flow)
+        return flow
+
+    def __len__(self):
+        return self.size
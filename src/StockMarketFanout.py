@@ -0,0 +1,164 @@
+# File: StockMarketFanout.py
+# Author: John Lee (jlee88@nd.edu) & David Simonneti (dsimone2@nd.edu)
+#
+# Description: Subscription table and UDP fan-out engine used by the simulator to publish to many subscribers
+
+import socket
+import threading
+import time
+from queue import SimpleQueue
+from StockMarketLib import LatencyHistogram, print_debug, SUBSCRIBE_TIMEOUT
+
+# number of sender threads, each owning a slice of the subscribers
+FANOUT_SHARDS = 4
+# kernel send buffer for each sender socket, large enough to absorb a whole publish burst
+FANOUT_SNDBUF = 4 * 1024 * 1024
+# width of one timer wheel slot, subscriptions expire with this granularity
+WHEEL_SLOT = 1e9
+
+class SubscriptionTable:
+    """Subscribers keyed by (host, port), expired through a hashed timer wheel.
+
+    Inserting or renewing a subscriber moves it to the wheel slot of its new expiry time,
+    so an address is only ever stored once no matter how often it resubscribes.
+    """
+    def __init__(self, timeout=SUBSCRIBE_TIMEOUT, slot=WHEEL_SLOT):
+        self.timeout = int(timeout)
+        self.slot = int(slot)
+        # enough slots that a subscription never wraps around the wheel before it expires
+        self.num_slots = self.timeout // self.slot + 2
+        self.slots = [set() for _ in range(self.num_slots)]
+        # maps address -> absolute slot number it expires in
+        self.expiry = {}
+        # maps address -> feed format the subscriber asked for ("json" or "binary")
+        self.formats = {}
+        # next absolute slot number to expire
+        self.cursor = time.time_ns() // self.slot
+
+    def renew(self, addr, feed_format="json", now=None):
+        """Inserts or renews a subscriber. Returns True if it was not subscribed before.
+        """
+        now = time.time_ns() if now is None else now
+        # round up so a subscription always lives for at least the full timeout
+        expires = -(-(now + self.timeout) // self.slot)
+        previous = self.expiry.get(addr)
+        if previous is not None:
+            self.slots[previous % self.num_slots].discard(addr)
+        self.expiry[addr] = expires
+        self.formats[addr] = feed_format
+        self.slots[expires % self.num_slots].add(addr)
+        return previous is None
+
+    def remove(self, addr):
+        """Drops a subscriber if it is subscribed
+        """
+        expires = self.expiry.pop(addr, None)
+        if expires is not None:
+            self.slots[expires % self.num_slots].discard(addr)
+            del self.formats[addr]
+
+    def expire(self, now=None):
+        """Removes and returns every subscriber whose subscription ran out
+        """
+        now = time.time_ns() if now is None else now
+        current = now // self.slot
+        expired = []
+        # only walk the slots that passed since the last call, and at most one full turn of the wheel
+        for tick in range(max(self.cursor, current - self.num_slots + 1), current + 1):
+            slot = self.slots[tick % self.num_slots]
+            for addr in [a for a in slot if self.expiry[a] <= current]:
+                slot.discard(addr)
+                del self.expiry[addr]
+                del self.formats[addr]
+                expired.append(addr)
+        self.cursor = max(self.cursor, current + 1)
+        return expired
+
+    def addresses(self, feed_format=None):
+        """List of every live subscriber, or only those using feed_format
+        """
+        if feed_format is None:
+            return list(self.expiry)
+        return [addr for addr, f in self.formats.items() if f == feed_format]
+
+    def __len__(self):
+        return len(self.expiry)
+
+    def __contains__(self, addr):
+        return addr in self.expiry
+
+class FanoutJob:
+    """A single publish that is shared between all shards
+    """
+    def __init__(self, payload, num_shards, histogram):
+        self.payload = payload
+        self.start = time.monotonic_ns()
+        self.remaining = num_shards
+        self.histogram = histogram
+        self.lock = threading.Lock()
+
+    def shard_done(self):
+        """Called by each shard once it has sent to all of its subscribers.
+        The last shard to finish records the fan-out time of the publish.
+        """
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining != 0:
+                return None
+        elapsed = time.monotonic_ns() - self.start
+        self.histogram.record(elapsed)
+        return elapsed
+
+class FanoutShard(threading.Thread):
+    """Sender thread with its own UDP socket
+    """
+    def __init__(self, publisher):
+        super().__init__(daemon=True)
+        self.publisher = publisher
+        self.jobs = SimpleQueue()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, FANOUT_SNDBUF)
+        except OSError:
+            pass
+
+    def run(self):
+        while True:
+            job, targets = self.jobs.get()
+            # the payload was encoded once by the publisher, so this is just a run of syscalls
+            sendto = self.sock.sendto
+            payload = job.payload
+            for addr in targets:
+                try:
+                    sendto(payload, addr)
+                except OSError:
+                    # a single bad subscriber address should not stop the rest of the shard
+                    pass
+            elapsed = job.shard_done()
+            if elapsed is not None:
+                self.publisher.last_fanout_time = elapsed
+
+class FanoutPublisher:
+    """Publishes one encoded payload to every subscriber, split across a set of sender threads.
+
+    publish() only hands the work to the shards, so the caller never waits on the sends.
+    The time from publish() until the last shard finishes is recorded in fanout_times.
+    """
+    def __init__(self, num_shards=FANOUT_SHARDS):
+        self.fanout_times = LatencyHistogram()
+        self.last_fanout_time = 0
+        self.shards = [FanoutShard(self) for _ in range(num_shards)]
+        for shard in self.shards:
+            shard.start()
+        print_debug(f"Fan-out started with {num_shards} sender threads.")
+
+    def publish(self, payload, targets):
+        """Sends payload (bytes) to every (host, port) in targets
+        """
+        if not targets:
+            return
+        # small publishes are not worth splitting across threads
+        num_shards = min(len(self.shards), max(1, len(targets) // 64))
+        job = FanoutJob(payload, num_shards, self.fanout_times)
+        for i in range(num_shards):
+            self.shards[i].jobs.put((job, targets[i::num_shards]))
@@ -0,0 +1,65 @@
+# File: StockMarketHashRing.py
+# Author: David Simonneti (dsimone2@nd.edu) & John Lee (jlee88@nd.edu)
+#
+# Description: Consistent hash ring that maps usernames onto replicator chains
+
+import bisect
+import hashlib
+import json
+import os
+
+# points each chain gets on the ring, more points spread users more evenly
+VNODES = 128
+
+def ring_hash(key):
+    """64 bit position of a string on the ring
+    """
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+class HashRing:
+    """Consistent hash ring with virtual nodes.
+
+    A username belongs to the chain owning the first point at or after the username's hash,
+    so adding or removing a chain only moves the users next to that chain's points.
+    """
+    def __init__(self, chains, vnodes=VNODES):
+        self.chains = sorted(set(int(c) for c in chains))
+        if not self.chains:
+            raise ValueError("A hash ring needs at least one chain")
+        self.vnodes = vnodes
+        points = sorted((ring_hash(f"chain-{chain}#{v}"), chain) for chain in self.chains for v in range(vnodes))
+        self.points = [point for point, _ in points]
+        self.owners = [chain for _, chain in points]
+
+    def lookup(self, username):
+        """Chain number that owns a username
+        """
+        i = bisect.bisect_left(self.points, ring_hash(username))
+        # wrap around past the last point
+        return self.owners[i % len(self.owners)]
+
+    def to_json(self):
+        return {"chains": self.chains, "vnodes": self.vnodes}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["chains"], data.get("vnodes", VNODES))
+
+    def save(self, path):
+        """Atomically writes the ring description to path
+        """
+        with open(path + ".shadow", "w") as f:
+            json.dump(self.to_json(), f)
+        os.replace(path + ".shadow", path)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a ring written by save, or returns None if there is none
+        """
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return cls.from_json(json.load(f))
+
+    def __eq__(self, other):
+        return isinstance(other, HashRing) and self.to_json() == other.to_json()
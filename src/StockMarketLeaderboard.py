@@ -0,0 +1,154 @@
+# File: StockMarketLeaderboard.py
+# Author: David Simonneti (dsimone2@nd.edu) & John Lee (jlee88@nd.edu)
+#
+# Description: Leaderboard of every user ordered by net worth, kept up to date one user at a time
+
+import random
+
+# levels of the skip list, enough for far more users than the system will ever have
+MAX_LEVEL = 32
+
+class SkipNode:
+    """Skip list node. width[level] is how many positions next[level] is ahead of this node
+    """
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        self.width = [1] * levels
+
+class IndexedSkipList:
+    """Sorted list of keys with O(log n) insert, remove, rank and lookup by position
+    """
+    def __init__(self):
+        self.head = SkipNode(None, MAX_LEVEL)
+        self.size = 0
+
+    def _level(self):
+        level = 1
+        while level < MAX_LEVEL and random.random() < 0.5:
+            level += 1
+        return level
+
+    def insert(self, key):
+        chain = [None] * MAX_LEVEL
+        steps_at_level = [0] * MAX_LEVEL
+        node = self.head
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and node.next[level].key < key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        levels = self._level()
+        new = SkipNode(key, levels)
+        steps = 0
+        for level in range(levels):
+            prev = chain[level]
+            new.next[level] = prev.next[level]
+            prev.next[level] = new
+            new.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        # links above the new node's height now jump over one more node
+        for level in range(levels, MAX_LEVEL):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain = [None] * MAX_LEVEL
+        node = self.head
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        target = chain[0].next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), MAX_LEVEL):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, key):
+        """Position (from 0) of key, or None if it is not in the list
+        """
+        node = self.head
+        position = 0
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        if node.next[0] is None or node.next[0].key != key:
+            return None
+        return position
+
+    def slice(self, start, count):
+        """Up to count keys from position start on
+        """
+        if start < 0 or start >= self.size or count <= 0:
+            return []
+        # walk down to the node at position start, counting the head as position -1
+        node = self.head
+        remaining = start + 1
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        keys = []
+        while node is not None and len(keys) < count:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+    def __len__(self):
+        return self.size
+
+class Leaderboard:
+    """Every user's latest net worth, ordered from richest to poorest.
+    Updating a user is O(log n), and version goes up whenever the order or a net worth changes.
+    """
+    def __init__(self):
+        self.ranking = IndexedSkipList()
+        # maps username -> net worth in the ranking
+        self.net_worths = {}
+        self.version = 0
+
+    def _key(self, username, net_worth):
+        # richest first, ties broken by username so every user has a unique key
+        return (-net_worth, username)
+
+    def update(self, username, net_worth):
+        """Sets a user's net worth, adding them if they are new
+        """
+        old = self.net_worths.get(username)
+        if old == net_worth:
+            return
+        if old is not None:
+            self.ranking.remove(self._key(username, old))
+        self.ranking.insert(self._key(username, net_worth))
+        self.net_worths[username] = net_worth
+        self.version += 1
+
+    def remove(self, username):
+        old = self.net_worths.pop(username, None)
+        if old is not None:
+            self.ranking.remove(self._key(username, old))
+            self.version += 1
+
+    def top(self, count, offset=0):
+        """(username, net worth) of count users from rank offset (0 is the richest) on
+        """
+        return [(username, -negative) for negative, username in self.ranking.slice(offset, count)]
+
+    def rank(self, username):
+        """Rank of a user (0 is the richest), or None if they are not on the leaderboard
+        """
+        net_worth = self.net_worths.get(username)
+        return None if net_worth is None else self.ranking.rank(self._key(username, net_worth))
+
+    def __len__(self):
+        return len(self.net_worths)
@@ -3,17 +3,25 @@
 # 
 # Description: Helper Library for Stock Market Methods
 
+import os
 import json
 import http.client
 import time
+import heapq
+import select
+import struct
+from array import array
+from functools import lru_cache
 
 ###################
 # Macro Variables #
 ###################
 
 ## Universe of Stocks
-VALID_TICKERS = ["TSLA", "MSFT", "AAPL", "NVDA", "AMZN"]
-VALID_STOCK_NAMES = ["Tesla", "Microsoft", "Apple", "Nvidia", "Amazon"]
+# every data/<TICKER>.csv next to this library is a stock in the universe
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data")
+DEFAULT_TICKERS = ["TSLA", "MSFT", "AAPL", "NVDA", "AMZN"]
+VALID_TICKERS = sorted(f[:-len(".csv")] for f in os.listdir(DATA_DIR) if f.endswith(".csv")) if os.path.isdir(DATA_DIR) else DEFAULT_TICKERS
 
 ## global speedup (default 1 = no speedup)
 GLOBAL_SPEEDUP = 1 
@@ -25,6 +33,24 @@ CLIENT_DELAY = 5
 ## Default Timeout for subscribes
 SUBSCRIBE_TIMEOUT = 30 * (1e9)
 
+## Binary tick packets
+# header: magic, version, flags, sequence number, timestamp in ns, number of entries
+TICK_MAGIC = b"SM"
+TICK_VERSION = 1
+TICK_HEADER = struct.Struct("!2sBBIQH")
+# every entry is a ticker index into the universe and its price in fixed point
+TICK_PRICE_SCALE = 100
+# flag set when a packet is part of a full snapshot of the universe rather than a delta
+TICK_FLAG_SNAPSHOT = 1
+# most entries carried by a single packet, so every datagram stays under the UDP size limit
+TICK_MAX_ENTRIES = 8192
+# most tickers carried by a single json update
+TICK_MAX_JSON_ENTRIES = 2048
+# publishes between two full snapshots, so subscribers that dropped a delta resync
+SNAPSHOT_INTERVAL = 50
+# TCP frames of binary packets are prefixed by their length
+PACKET_HEADER = struct.Struct("!I")
+
 ## DEBUG Mode
 # DEBUG = True
 DEBUG = False
@@ -36,13 +62,16 @@ DEBUG = False
 class StockMarketUser:
     """Defines a User for the broker to register
     """
+    # a replicator holds every user of its shard, so they are kept small
+    __slots__ = ("username", "password", "cash", "stocks")
+
     def __init__(self, username, password):
         self.username = username
         self.password = password
         # init w/ 100k
         self.cash = 100000
-        # init stocks
-        self.stocks = {ticker: 0 for ticker in VALID_TICKERS}
+        # init stocks, only tickers that are actually held are kept
+        self.stocks = {}
 
     def can_purchase(self, amount, price):
         """Checks that you have enough money to purchase.
@@ -52,19 +81,29 @@ class StockMarketUser:
     def can_sell(self, amount, ticker):
         """Checks that you have enough of a certain stock to sell
         """
-        return (self.stocks[ticker] >= amount)
+        return (self.stocks.get(ticker, 0) >= amount)
     
     def purchase(self, ticker, amount, price):
         """Purchase a stock
         """
         self.cash -= amount * price
-        self.stocks[ticker] += amount
+        self.stocks[ticker] = self.stocks.get(ticker, 0) + amount
     
     def sell(self, ticker, amount, price):
         """Sell your stocks
         """
         self.cash += amount * price
-        self.stocks[ticker] -= amount
+        self.stocks[ticker] = self.stocks.get(ticker, 0) - amount
+        if self.stocks[ticker] == 0:
+            del self.stocks[ticker]
+
+    def net_worth(self, prices):
+        """Cash plus the value of every holding at the given prices (a PriceTable or dict)
+        """
+        nw = self.cash
+        for ticker, amount in self.stocks.items():
+            nw += amount * prices[ticker]
+        return nw
         
     def print_debug(self, *values):
         print_debug(self.username, "--", *values)
@@ -80,6 +119,226 @@ class StockMarketUser:
             user_str += "-" * 16 + '\n'
         return user_str
 
+###############
+# Price Class #
+###############
+
+class PriceTable:
+    """Latest price of every ticker in the universe, held in an array indexed like the universe
+    """
+    def __init__(self, tickers):
+        self.tickers = list(tickers)
+        self.index = {ticker: i for i, ticker in enumerate(self.tickers)}
+        self.prices = array("d", bytes(8 * len(self.tickers)))
+        # sequence number and time of the latest tick applied
+        self.seq = 0
+        self.time = 0
+
+    def apply(self, entries, seq=None, time_ns=None):
+        """Applies (ticker index, price) pairs from a tick
+        """
+        prices = self.prices
+        for index, price in entries:
+            prices[index] = price
+        if seq is not None:
+            self.seq = seq
+        if time_ns is not None:
+            self.time = time_ns
+
+    def load(self, prices):
+        """Replaces every price with a list ordered like the universe
+        """
+        if len(prices) == len(self.prices):
+            self.prices = array("d", prices)
+
+    def tolist(self):
+        """Every price, ordered like the universe
+        """
+        return self.prices.tolist()
+
+    def __getitem__(self, ticker):
+        return self.prices[self.index[ticker]]
+
+    def __contains__(self, ticker):
+        return ticker in self.index
+
+    def __len__(self):
+        return len(self.tickers)
+
+######################
+# Scheduling Classes #
+######################
+
+class LatencyHistogram:
+    """Histogram of latencies in power-of-two microsecond buckets
+    """
+    def __init__(self, num_buckets=32):
+        # bucket 0 counts latencies under 1us, bucket k counts [2^(k-1), 2^k) us
+        self.buckets = [0] * num_buckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, latency_ns):
+        """Adds a single latency measurement in nanoseconds
+        """
+        latency_ns = max(0, int(latency_ns))
+        self.buckets[min((latency_ns // 1000).bit_length(), len(self.buckets) - 1)] += 1
+        self.count += 1
+        self.total += latency_ns
+        self.max = max(self.max, latency_ns)
+
+    def percentile(self, p):
+        """Returns an upper bound in microseconds for the p-th percentile latency
+        """
+        if self.count == 0:
+            return 0
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= self.count * p / 100:
+                return 1 << bucket
+        return 1 << (len(self.buckets) - 1)
+
+    def __repr__(self):
+        """Summary of the histogram
+        """
+        mean = self.total / self.count / 1000 if self.count else 0
+        return f"n={self.count} mean={mean:.1f}us p50<={self.percentile(50)}us p99<={self.percentile(99)}us max={self.max / 1000:.1f}us"
+
+class EventScheduler:
+    """Deadline-based scheduler for periodic events.
+
+    Next-fire times are kept in a heap, and the scheduler blocks in select until either
+    the nearest deadline passes or a registered socket becomes readable.
+    How late each event fires is recorded in a per-event LatencyHistogram.
+    """
+    def __init__(self):
+        # heap of (deadline, registration order, event name)
+        self.events = []
+        self.periods = {}
+        self.callbacks = {}
+        self.jitter = {}
+        # maps socket -> callback to run when it is readable
+        self.readers = {}
+
+    def every(self, name, period_ns, callback):
+        """Fires callback(periods) every period_ns nanoseconds, starting one period from now.
+        periods is the number of periods that elapsed since the last time the event fired.
+        """
+        period_ns = int(period_ns)
+        self.periods[name] = period_ns
+        self.callbacks[name] = callback
+        self.jitter[name] = LatencyHistogram()
+        heapq.heappush(self.events, (time.monotonic_ns() + period_ns, len(self.callbacks), name))
+
+    def add_reader(self, sock, callback):
+        """Runs callback() whenever sock is readable
+        """
+        self.readers[sock] = callback
+
+    def remove_reader(self, sock):
+        """Stops watching sock
+        """
+        self.readers.pop(sock, None)
+
+    def run_once(self):
+        """Waits until the nearest deadline or socket readiness and runs everything that is due
+        """
+        timeout = None
+        if self.events:
+            timeout = max(0, self.events[0][0] - time.monotonic_ns()) / 1e9
+        if self.readers:
+            readable, _, _ = select.select(list(self.readers), [], [], timeout)
+            for sock in readable:
+                self.readers[sock]()
+        elif timeout is not None:
+            time.sleep(timeout)
+
+        now = time.monotonic_ns()
+        while self.events and self.events[0][0] <= now:
+            deadline, order, name = heapq.heappop(self.events)
+            self.jitter[name].record(now - deadline)
+            # keep a fixed rate, folding any periods that were missed entirely into this firing
+            period = self.periods[name]
+            periods = (now - deadline) // period + 1
+            heapq.heappush(self.events, (deadline + periods * period, order, name))
+            self.callbacks[name](periods)
+            now = time.monotonic_ns()
+
+    def run(self):
+        """Runs the scheduler forever
+        """
+        while True:
+            self.run_once()
+
+##################
+# Socket Classes #
+##################
+
+class BufferedConnection:
+    """Non-blocking stream socket with read and write buffers, for use with an event loop.
+
+    read() parses every complete message that has arrived with parser (parse_message or parse_packet),
+    and send() queues bytes, writing as much as the socket takes right away.
+    """
+    def __init__(self, sock, parser=None):
+        sock.setblocking(False)
+        self.sock = sock
+        self.parser = parser or parse_message
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self):
+        """Reads what is available and returns the list of complete messages,
+        or None if the connection was closed. Raises ValueError on a badly formatted message.
+        """
+        try:
+            data = self.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            return None
+        if not data:
+            return None
+        self.inbuf += data
+        messages = []
+        offset = 0
+        while True:
+            message, offset = self.parser(self.inbuf, offset)
+            if message is None:
+                break
+            messages.append(message)
+        # drop the parsed messages in one go, rather than once per message
+        del self.inbuf[:offset]
+        return messages
+
+    def send(self, data):
+        """Queues data and writes as much as possible. Returns True if everything has been written.
+        Raises OSError if the connection broke.
+        """
+        self.outbuf += data
+        return self.flush()
+
+    def flush(self):
+        """Writes as much of the queued data as the socket takes. Returns True if everything has been written.
+        """
+        while self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+            except (BlockingIOError, InterruptedError):
+                return False
+            del self.outbuf[:sent]
+        return True
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
 ####################
 # Helper Functions #
 ####################
@@ -100,6 +359,65 @@ def format_message(json_message):
     return encoded_request
 
 
+@lru_cache(maxsize=None)
+def _tick_entries(count):
+    """Struct for count (ticker index, fixed point price) entries
+    """
+    return struct.Struct("!" + "Hi" * count)
+
+def encode_tick(seq, time_ns, prices, flags=TICK_FLAG_SNAPSHOT):
+    """Packs a tick into the binary wire format.\n
+        prices is a list of (ticker index, price) pairs, and each entry takes 6 bytes on the wire"""
+    entries = []
+    for index, price in prices:
+        entries.append(index)
+        entries.append(int(round(price * TICK_PRICE_SCALE)))
+    header = TICK_HEADER.pack(TICK_MAGIC, TICK_VERSION, flags, seq & 0xFFFFFFFF, time_ns, len(prices))
+    return header + _tick_entries(len(prices)).pack(*entries)
+
+def decode_tick_entries(packet):
+    """Unpacks a binary tick into (flags, seq, time_ns, [(ticker index, price), ...]).\n
+        Raises ValueError on a malformed packet"""
+    try:
+        magic, version, flags, seq, time_ns, count = TICK_HEADER.unpack_from(packet)
+        entries = _tick_entries(count).unpack_from(packet, TICK_HEADER.size)
+    except struct.error as e:
+        raise ValueError(f"Malformed tick packet: {e}")
+    if magic != TICK_MAGIC or version != TICK_VERSION:
+        raise ValueError(f"Unsupported tick packet version {version}")
+    return flags, seq, time_ns, [(entries[i], entries[i + 1] / TICK_PRICE_SCALE) for i in range(0, len(entries), 2)]
+
+def decode_tick(packet, tickers):
+    """Unpacks a binary tick into the same dictionary a json update would be decoded into.\n
+        tickers is the universe the entries index into. Raises ValueError on a malformed packet"""
+    flags, seq, time_ns, entries = decode_tick_entries(packet)
+    update = {"type": "stockmarketsimupdate", "time": time_ns, "seq": seq, "snapshot": bool(flags & TICK_FLAG_SNAPSHOT)}
+    for index, price in entries:
+        update[tickers[index]] = price
+    return update
+
+def format_packet(packet):
+    """Frames a binary packet for a stream socket by prefixing its length
+    """
+    return PACKET_HEADER.pack(len(packet)) + packet
+
+def receive_packet(socket):
+    """Reads a single length prefixed binary packet from a stream socket,
+    returns a tuple in the same form as receive_data with the packet bytes as the second element"""
+    data = b""
+    size = None
+    while size is None or len(data) < PACKET_HEADER.size + size:
+        try:
+            partial = socket.recv(PACKET_HEADER.size - len(data) if size is None else PACKET_HEADER.size + size - len(data))
+        except Exception as e:
+            return (1, "Request timed out")
+        if len(partial) == 0:
+            return (0, None)
+        data += partial
+        if size is None and len(data) == PACKET_HEADER.size:
+            size = PACKET_HEADER.unpack(data)[0]
+    return (0, data[PACKET_HEADER.size:])
+
 def receive_data(socket):
     """Function that takes a socket and attempts to read a properly formatted message from it,
     returns a tuple where the first element is either a 0 for a success or 1 for a failure 
@@ -161,35 +479,74 @@ def receive_data(socket):
         return (2, "Json is not valid")
     return (0, request_json)
 
-def lookup_server(broker_name, server_type):
+def parse_message(buffer, start=0):
+    """Non-blocking counterpart of receive_data, parses one formatted message from buffer (bytes) at offset start.
+    Returns a tuple of the json message and the offset just past it,
+    or (None, start) if the buffer does not hold a complete message yet.
+    Raises ValueError if the buffer does not hold a properly formatted message at start."""
+    size_delimiter = buffer.find(b"\n", start)
+    if size_delimiter == -1:
+        # the length header is only a few digits
+        if len(buffer) - start > 20:
+            raise ValueError("Length of request in header must be an integer")
+        return (None, start)
+    size = int(buffer[start:size_delimiter])
+    end = size_delimiter + 1 + size
+    if len(buffer) <= end:
+        return (None, start)
+    if buffer[end:end + 1] != b"\n":
+        raise ValueError("Length of request in header does not match actual request length")
+    return (json.loads(buffer[size_delimiter + 1:end]), end + 1)
+
+def parse_packet(buffer, start=0):
+    """Non-blocking counterpart of receive_packet, in the same form as parse_message with the packet bytes as the message
+    """
+    if len(buffer) - start < PACKET_HEADER.size:
+        return (None, start)
+    size = PACKET_HEADER.unpack_from(buffer, start)[0]
+    end = start + PACKET_HEADER.size + size
+    if len(buffer) < end:
+        return (None, start)
+    return (bytes(buffer[start + PACKET_HEADER.size:end]), end)
+
+def lookup_server(broker_name, server_type, max_attempts=None, timeout=None):
     """Lookup the Name server
+
+    max_attempts (int): how many lookups are made before giving up with no servers, unlimited by default
+    timeout    (float): how long each request to the name server may take, in seconds
     """
-    timeout = 1
+    retry = 1
+    attempts = 0
     while True:
+        attempts += 1
         # make http connection to name server and get json formatted info
         try:
-            ns_conn = http.client.HTTPConnection('catalog.cse.nd.edu:9097')
+            ns_conn = http.client.HTTPConnection('catalog.cse.nd.edu:9097', timeout=timeout)
             ns_conn.request("GET", "/query.json")
             html = ns_conn.getresponse().read()
             ns_conn.close()
+            # load into python dict
+            json_response = json.loads(html)
         except Exception as e:
-            print(f"Unable to contact catalog server, retrying in {timeout} seconds")
-            time.sleep(timeout)
-            timeout *= 2
+            if max_attempts is not None and attempts >= max_attempts:
+                return []
+            print(f"Unable to contact catalog server, retrying in {retry} seconds")
+            time.sleep(retry)
+            retry *= 2
             continue
 
-        # load into python dict
-        json_response = json.loads(html)
         # iterate over all servers and check which ones have the correct broker name and type
         possible_brokers = []
         for broker in json_response:
             if broker.get("project", None) == broker_name and broker.get("type", None) == server_type:
                 possible_brokers.append(broker)
         # error case for no servers found - try again
-        if possible_brokers == []:        
-            print(f"Unable to lookup {server_type} with project name {broker_name} from catalog server, retrying in {timeout} seconds")
-            time.sleep(timeout)
-            timeout *= 2
+        if possible_brokers == []:
+            if max_attempts is not None and attempts >= max_attempts:
+                return []
+            print(f"Unable to lookup {server_type} with project name {broker_name} from catalog server, retrying in {retry} seconds")
+            time.sleep(retry)
+            retry *= 2
             continue
         return possible_brokers
 
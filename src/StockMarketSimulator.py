@@ -3,41 +3,107 @@
 # 
 # Description: Script to start Stock Market Simulator
 
-import random
 from collections import deque
 import time
 import socket
 import json
-import select
-# import numpy as np
+import numpy as np
 import signal
-import csv
 import sys
-from StockMarketLib import format_message, receive_data, print_debug, VALID_TICKERS, SUBSCRIBE_TIMEOUT, GLOBAL_SPEEDUP, MINUTE_SPEEDUP, CLIENT_DELAY
+import threading
+from queue import SimpleQueue, Empty
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from StockMarketAcceptor import HandshakeAcceptor
+from StockMarketBarStore import BarStore
+from StockMarketFanout import FanoutPublisher, SubscriptionTable
+from StockMarketLib import EventScheduler, format_message, format_packet, print_debug, VALID_TICKERS, GLOBAL_SPEEDUP, MINUTE_SPEEDUP, CLIENT_DELAY, SNAPSHOT_INTERVAL, TICK_HEADER, TICK_MAGIC, TICK_VERSION, TICK_FLAG_SNAPSHOT, TICK_PRICE_SCALE, TICK_MAX_ENTRIES, TICK_MAX_JSON_ENTRIES
+
+# layout of the entries of a binary tick packet, see encode_tick in StockMarketLib
+TICK_ENTRY_DTYPE = np.dtype([("index", ">u2"), ("price", ">i4")])
+
+# number of ticks sent to subscribers that are kept for history queries (5 minutes of publishes)
+HISTORY_LENGTH = 3000
 
 # Testing Macro for test methods
 # TEST = True
 TEST = False
 
+class TickHistory:
+    """Fixed-size ring buffer of the last ticks sent to subscribers.
+    Prices are kept in fixed point, one row per tick and one column per ticker.
+    """
+    def __init__(self, num_tickers, length=HISTORY_LENGTH):
+        self.length = length
+        self.prices = np.zeros((length, num_tickers), dtype=np.int32)
+        self.seqs = np.zeros(length, dtype=np.int64)
+        self.times = np.zeros(length, dtype=np.int64)
+        # total number of ticks ever appended
+        self.count = 0
+        # history queries are answered on the acceptor thread while the publish loop appends
+        self.lock = threading.Lock()
+
+    def append(self, seq, time_ns, prices):
+        """Adds a tick, overwriting the oldest one once the buffer is full
+        """
+        fixed = np.rint(prices * TICK_PRICE_SCALE)
+        with self.lock:
+            slot = self.count % self.length
+            self.prices[slot] = fixed
+            self.seqs[slot] = seq
+            self.times[slot] = time_ns
+            self.count += 1
+
+    def last(self, n, indices=None):
+        """Returns (seqs, times, prices) of the last n ticks, oldest first, for the tickers at indices
+        """
+        with self.lock:
+            return self._read(n, indices)
+
+    def since(self, seq, indices=None):
+        """Returns (seqs, times, prices) of every tick still in the buffer with a sequence number of at least seq
+        """
+        with self.lock:
+            # ticks sent to subscribers have consecutive sequence numbers
+            latest = self.seqs[(self.count - 1) % self.length] if self.count else seq - 1
+            return self._read(int(latest - seq + 1), indices)
+
+    def _read(self, n, indices):
+        """Copies out the last n ticks, the lock must be held
+        """
+        n = max(0, min(n, self.length, self.count))
+        slots = np.arange(self.count - n, self.count) % self.length
+        prices = self.prices[slots] if indices is None else self.prices[np.ix_(slots, indices)]
+        return self.seqs[slots], self.times[slots], prices / TICK_PRICE_SCALE
+
 class StockMarketSimulator:
     """Simulates the Stock Market with the universe of stocks.
     """
-    def __init__(self, name):
+    def __init__(self, name, warp=None):
+        """
+        Args:
+            name   (str): project name
+            warp (tuple): optional (start, end) unix timestamps of historical data to replay in time-warp mode
+        """
         ## Project Name
         self.name = name
         
-        ## Set Tickers
+        ## Set Tickers, discovered from the data directory
         self.tickers = VALID_TICKERS
         self.num_tickers = len(self.tickers)
+        self.ticker_index = {t: i for i, t in enumerate(self.tickers)}
         
         ## Loading Stock Prices
-        self.stock_prices = {}
-        for t in self.tickers:
-            with open(f'data/{t}.csv') as csvfile:
-                reader = csv.reader(csvfile)
-                self.stock_prices[t] = list(reader)
-                print_debug(f"Minute prices loaded for {t}.")
-        self.minute = 1
+        self.bar_store = BarStore(self.tickers)
+        self.minute = 0
+
+        ## Time-Warp
+        # in time-warp mode the minutes come from the chosen date range, and time is virtual
+        self.warp = warp
+        if self.warp:
+            self.warp_minutes = self.bar_store.minutes_between(*warp)
+            print_debug(f"Time-warp over {len(self.warp_minutes)} minutes.")
+        self.virtual_time = 0
         
         ## Set Rates
         # publish every 1/2 second
@@ -50,10 +116,38 @@ class StockMarketSimulator:
         self.minute_rate = MINUTE_SPEEDUP * 60 * 1e9 / GLOBAL_SPEEDUP # change this for faster volatility
         print_debug(f"Minute rate = {self.minute_rate / 1e9} seconds/minute")
         
-        self.simulate_next_minute()
+        ## Minute Paths
+        # number of simulated points in a single minute
+        self.points_per_minute = int(self.minute_rate//self.update_rate + 1)
+        # only the points that can actually be published are generated
+        self.path_stride = max(1, int(self.publish_rate // self.update_rate))
+        self.rng = np.random.default_rng()
+        # minute N+1 is built in the background while minute N is being published
+        self.path_executor = ThreadPoolExecutor(max_workers=1)
+        self.next_minute = self._build_minute_path(self.minute)
+        self.minute += 1
+        self.pending_minute = self.path_executor.submit(self._build_minute_path, self.minute)
         
+        ## Scheduler driving the tick, publish and minute events
+        self.scheduler = EventScheduler()
+
         ## save data to artificially delay it.
         self.delayed_data = deque()
+        # sequence number of the latest publish
+        self.seq = 0
+        # maps broker connection -> [feed format it negotiated, prices last sent to it], one per broker front-end
+        self.brokers = {}
+        # prices last sent to subscribers, deltas are computed against them
+        self.client_prices = None
+        # subscribers that joined since the last publish and need a full snapshot
+        self.fresh_subs = set()
+        # recent ticks sent to subscribers, for late joiners and gap filling
+        self.history = TickHistory(self.num_tickers)
+        # handshakes finished by the acceptor thread, applied by the publish loop
+        self.handshakes = SimpleQueue()
+        # replies to first subscriptions and binary brokers never change, so they are only encoded once
+        self.tickers_json = json.dumps({"tickers": self.tickers}).encode("utf-8")
+        self.tickers_message = format_message({"tickers": self.tickers})
         if TEST: self.prev_pub_time = 0
 
         ## Open a socket to accept new client subscriptions
@@ -66,6 +160,8 @@ class StockMarketSimulator:
             exit(1)
         self.host, self.port = self.recv_socket.getsockname()
         print_debug(f"Listening on port {self.port}")
+        # handshakes run on their own thread, so slow or stuck clients never hold up a publish
+        self.acceptor = HandshakeAcceptor(self.recv_socket, self._handshake)
         
         # Publish Socket, bind to a port.
         self._init_pub_socket()
@@ -80,10 +176,8 @@ class StockMarketSimulator:
     def _init_pub_socket(self):
         """Initializes publish socket
         """
-        self.pub_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.pub_port = self.pub_socket.getsockname()[1]
-        self.sub_table = deque()
-        self.sub_set = set()
+        self.fanout = FanoutPublisher()
+        self.sub_table = SubscriptionTable()
         
 
     def _init_ns_socket(self):
@@ -109,20 +203,70 @@ class StockMarketSimulator:
                     }
         self.ns_socket.sendall(json.dumps(update_msg).encode("utf-8"))
         print_debug("Name Server updated.")
+        for event, jitter in self.scheduler.jitter.items():
+            print_debug(f"{event} jitter: {jitter}")
+        print_debug(f"fanout time: {self.fanout.fanout_times}")
+        print_debug(f"handshakes: {self.acceptor.outcomes}")
         
-    def accept_new_connection(self):
-        """ Add a new client to the subscription table
-        """
-        conn, addr = self.recv_socket.accept()
-        error_code, data = receive_data(conn)
-        if data.get("type", None) == "broker":
-            self.broker_connection = conn
-            print_debug(f"New Broker {addr} connected.")
+    def _history_reply(self, request):
+        """Answers a history query.
+        request = {"type": "history", "last": N} or {"type": "history", "since": sequence number},
+        optionally with "tickers": [...] to only get some tickers.
+        """
+        tickers = [t for t in request.get("tickers", None) or self.tickers if t in self.ticker_index]
+        indices = None if tickers == self.tickers else [self.ticker_index[t] for t in tickers]
+        try:
+            if request.get("since", None) is not None:
+                seqs, times, prices = self.history.since(int(request["since"]), indices)
+            else:
+                seqs, times, prices = self.history.last(int(request.get("last", 100)), indices)
+        except (TypeError, ValueError):
+            return {"Success": False, "Value": "last and since must be integers"}
+        return {"Success": True, "Value": {"tickers": tickers, "seqs": seqs.tolist(), "times": times.tolist(), "prices": prices.tolist()}}
+
+    def now_ns(self):
+        """Current time of the simulation, virtual in time-warp mode
+        """
+        return self.virtual_time if self.warp else time.time_ns()
+
+    def _handshake(self, request, addr):
+        """Answers a new connection's first request, runs on the acceptor thread.
+        Anything that touches the subscription table is queued for the publish loop.
+        """
+        if request.get("type", None) == "broker":
+            broker_format = request.get("format", "json")
+            # binary brokers learn the universe the packets index into, then start from a full snapshot
+            reply = format_packet(self.tickers_json) if broker_format == "binary" else None
+            return reply, lambda conn: self.handshakes.put(("broker", conn, broker_format, addr))
+        elif request.get("type", None) == "history":
+            print_debug(f"History sent to {addr}.")
+            return format_message(self._history_reply(request)), None
         else:
-            self.sub_table.append(((data["hostname"], data["port"]), time.time_ns()))
-            self.sub_set.add((data["hostname"], data["port"]))
-            conn.close()
-            print_debug(f"New Subscriber connected.")
+            sub_addr = (request["hostname"], request["port"])
+            self.handshakes.put(("subscriber", sub_addr, request.get("format", "json")))
+            # first subscriptions learn the universe and get a full snapshot on the next publish
+            return (None if request.get("resub", False) else self.tickers_message), None
+
+    def accept_new_connections(self, wait_for_broker=False):
+        """ Applies every handshake the acceptor finished since the last call,
+        blocking until a broker connects if wait_for_broker is set and there is none
+        """
+        while True:
+            try:
+                handshake = self.handshakes.get(block=wait_for_broker and not self.brokers)
+            except Empty:
+                return
+            if handshake[0] == "broker":
+                _, conn, broker_format, addr = handshake
+                # a broker that reconnected leaves its old connection behind, which is dropped on the next publish
+                self.brokers[conn] = [broker_format, None]
+                print_debug(f"New Broker {addr} connected.")
+            else:
+                _, addr, feed_format = handshake
+                new = self.sub_table.renew(addr, feed_format)
+                if new:
+                    self.fresh_subs.add(addr)
+                print_debug(f"New Subscriber connected." if new else "Subscriber renewed.")
     
     ##########################
     # Main Simulation Method #
@@ -133,51 +277,85 @@ class StockMarketSimulator:
         """
         # start listening
         self.recv_socket.listen()
-        prev_update_time = time.time_ns()
-        prev_sub_time = prev_update_time
-        prev_min_time = prev_update_time
+        self.acceptor.start()
         self.tick = 0
-        while True:
-            
-            # check if we have a new subscriber trying to connect
-            readable, _, _ = select.select([self.recv_socket], [], [], 0)
-            if readable != []:
-                self.accept_new_connection()
-            
-            cur_time = time.time_ns()
-            
-            # update the minute to use for simulation
-            if (cur_time - prev_min_time) > self.minute_rate:
-                prev_min_time = cur_time
-                self.simulate_next_minute()
-                self.tick = 0
-                
-            # try to update
-            if (cur_time - prev_update_time) > self.update_rate:
-                prev_update_time = cur_time
-                self.tick += 1
-                #self.simulate_one_tick(tick)
-
-            # don't publish every
-            if (cur_time - prev_sub_time) > self.publish_rate:
+        # events that are due at the same time fire in the order they are registered
+        self.scheduler.every("minute", self.minute_rate, self._on_minute)
+        self.scheduler.every("tick", self.update_rate, self._on_tick)
+        self.scheduler.every("publish", self.publish_rate, self._on_publish)
+        self.scheduler.run()
+
+    def _on_minute(self, periods):
+        """update the minute to use for simulation
+        """
+        self.simulate_next_minute()
+        self.tick = 0
+
+    def _on_tick(self, periods):
+        """advance the simulation by every update that has elapsed
+        """
+        self.tick += periods
+
+    def _on_publish(self, periods):
+        """publish the current prices, late publishes are not made up
+        """
+        # take any new subscribers and brokers first, so fresh subscribers get this publish
+        self.accept_new_connections()
+        self.publish_stock_data()
+
+    def simulate_warp(self):
+        """Replay the time-warp date range as fast as the broker absorbs ticks.
+        The broker connection is a blocking socket, so a full send buffer holds back the virtual clock.
+        """
+        self.recv_socket.listen()
+        self.acceptor.start()
+        # publish at the same virtual cadence as a real run
+        stride = int(self.publish_rate // self.update_rate)
+        update_ns = 60 * 1e9 / (self.points_per_minute - 1)
+        start = time.time_ns()
+        published = 0
+        while self.next_minute is not None:
+            minute_start = int(self.warp_minutes[self.minute - 1] * 1e9)
+            for self.tick in range(0, self.points_per_minute - 1, stride):
+                self.virtual_time = minute_start + int(self.tick * update_ns)
+                # take any new subscribers, and wait for a broker if there isn't one to push back on us
+                self.accept_new_connections(wait_for_broker=True)
                 self.publish_stock_data()
-                prev_sub_time = cur_time
+                published += 1
+            print_debug(f"Replayed minute {datetime.fromtimestamp(minute_start / 1e9, timezone.utc)}")
+            self.simulate_next_minute()
+        elapsed = (time.time_ns() - start) / 1e9
+        print(f"Replayed {len(self.warp_minutes)} minutes, {published} ticks in {elapsed:.2f} seconds ({published / elapsed:.1f} ticks/sec)")
     
     ###############
     # Sim Backend #
     ###############
     
     def simulate_next_minute(self):
-        '''Simulates the next minute's data by using a random walk over a minute bar'''
-        self.next_minute = {}
-        x = [i for i in range(int(self.minute_rate//self.update_rate + 1))]
-        for t in self.tickers:
-            min = self.stock_prices[t][self.minute]
-            # compute linear step
-            tmp = [((float(min[5]) - float(min[2])) / (self.minute_rate/self.update_rate)) * i + float(min[2]) for i in x]
-            # add random noise
-            self.next_minute[t] = [round(i + random.gauss(0, random.uniform(.1, 1.9) * abs(float(min[3]) - float(min[4])) + .01), 2)  for i in tmp]
+        '''Swaps in the pre-generated path for the next minute and starts building the one after it'''
+        self.next_minute = self.pending_minute.result()
         self.minute += 1
+        self.pending_minute = self.path_executor.submit(self._build_minute_path, self.minute)
+
+    def _build_minute_path(self, minute):
+        '''Simulates a minute's data for every ticker at once by using a random walk over its minute bar.
+        Returns an array with one row of prices per ticker and one column per publish,
+        or None once a time-warp has run out of minutes.'''
+        # open, high, low, close of the minute bar for each ticker
+        if not self.warp:
+            bars = self.bar_store.bars(minute)
+        elif minute < len(self.warp_minutes):
+            bars = self.bar_store.bars_at(self.warp_minutes[minute])
+        else:
+            return None
+        opens, highs, lows, closes = bars.T
+        # compute linear step from open to close, at every point that gets published
+        x = np.arange(0, self.points_per_minute, self.path_stride)
+        path = opens[:, None] + ((closes - opens) / (self.minute_rate/self.update_rate))[:, None] * x
+        # add random noise, scaled by a random fraction of the bar's range at every point
+        scale = self.rng.uniform(.1, 1.9, size=path.shape) * np.abs(highs - lows)[:, None] + .01
+        path += self.rng.normal(0, scale)
+        return np.round(path, 2)
 
     
     ##################
@@ -185,62 +363,147 @@ class StockMarketSimulator:
     ##################
 
     def publish_stock_data(self):
-        """Publishes Stock Data to every subscriber
+        """Publishes Stock Data to every subscriber, in the feed format each of them asked for.
+        Only the tickers whose price changed since the previous publish are sent, with a full snapshot
+        every SNAPSHOT_INTERVAL publishes and for anyone that just connected.
         
-        msg = { "type" : "stockmarketsimupdate",
-                "time": time.time_ns(),
-                "TSLA": ...,
-                "MSFT": ...,
-                "NVDA": ...,
-                "AAPL": ...,
-                "AMZN": ...,}
+        json:   { "type" : "stockmarketsimupdate",
+                  "time": time.time_ns(),
+                  "seq": sequence number,
+                  "snapshot": whether every ticker is included,
+                  "AAPL": ...,
+                  ...}
+        binary: see encode_tick in StockMarketLib
         """
         start = time.time_ns()
-        # message for each ticker
-        update = {"type" : "stockmarketsimupdate", "time": start}
-        for t in self.tickers:
-            update[t] = self.next_minute[t][self.tick]
+        stamp = self.now_ns()
+        self.seq += 1
+        prices = self.next_minute[:, min(round(self.tick / self.path_stride), self.next_minute.shape[1] - 1)]
 
-        message = json.dumps(update)
-        try:
-            self.broker_connection.sendall(format_message(message))
-        except Exception as e:
-            pass
+        # brokers that are caught up get the same delta, so it is only encoded once per feed format
+        encoded = {}
+        for conn, broker in list(self.brokers.items()):
+            broker_format, broker_prices = broker
+            snapshot = broker_prices is None or self.seq % SNAPSHOT_INTERVAL == 0
+            key = (broker_format, None if snapshot else id(broker_prices))
+            if key not in encoded:
+                changed = self._changed_tickers(prices, None if snapshot else broker_prices)
+                if broker_format == "binary":
+                    encoded[key] = b"".join(format_packet(packet) for packet in self._encode_packets(self.seq, stamp, changed, prices[changed], snapshot))
+                else:
+                    encoded[key] = b"".join(format_message(update) for update in self._json_updates(self.seq, stamp, changed, prices[changed], snapshot))
+            try:
+                if encoded[key]:
+                    conn.sendall(encoded[key])
+                broker[1] = prices
+            except Exception as e:
+                # broker went away, wait for it to reconnect
+                conn.close()
+                del self.brokers[conn]
 
         # append the current message to the data queue
-        self.delayed_data.append(message)
+        self.delayed_data.append((stamp, self.seq, prices))
         if len(self.delayed_data) <= CLIENT_DELAY:
             return
         # retrieve the delayed data in the queue. This message will be sent to users
-        message = self.delayed_data.popleft()
+        stamp, seq, prices = self.delayed_data.popleft()
 
         
         # remove out of date subscribers
-        cur_time = time.time_ns()
-        out_of_date_subs = []
-        while self.sub_table:
-            if (cur_time - self.sub_table[0][1]) > SUBSCRIBE_TIMEOUT:
-                out_of_date_subs.append(self.sub_table.popleft())
-            else:
-                break
+        out_of_date_subs = self.sub_table.expire()
         if len(out_of_date_subs) != 0:
             print_debug(f"Removed {len(out_of_date_subs)} subs.")
             
         # send data to subscribed sockets
-        print_debug(f"Publishing to {len(self.sub_table)} clients...", update)
+        print_debug(f"Publishing to {len(self.sub_table)} clients...")
 
-        for sub_sock in self.sub_table:
-            self.pub_socket.sendto(message.encode("utf-8"), sub_sock[0])
-            print(sub_sock, message)
+        snapshot = self.client_prices is None or seq % SNAPSHOT_INTERVAL == 0
+        changed = self._changed_tickers(prices, None if snapshot else self.client_prices)
+        everything = self._changed_tickers(prices, None)
+        for feed_format, encode in (("json", self._encode_json), ("binary", self._encode_packets)):
+            targets = self.sub_table.addresses(feed_format)
+            if not targets:
+                continue
+            fresh = [addr for addr in targets if addr in self.fresh_subs] if not snapshot else []
+            if fresh:
+                targets = [addr for addr in targets if addr not in self.fresh_subs]
+                for payload in encode(seq, stamp, everything, prices, True):
+                    self.fanout.publish(payload, fresh)
+            # encode once, the fan-out threads send the same bytes to every subscriber
+            for payload in encode(seq, stamp, changed, prices[changed], snapshot):
+                self.fanout.publish(payload, targets)
+        self.fresh_subs.clear()
+        self.client_prices = prices
+        self.history.append(seq, stamp, prices)
             
         if TEST:
             end = time.time_ns()
             pub_time = end - start
-            print(f"Num clients: {len(self.sub_table)}, Publish Time: {pub_time/1e9}, Start Int: {(start - self.prev_pub_time)/1e9}, End Int: {(end - self.prev_pub_time)/1e9}")
+            print(f"Num clients: {len(self.sub_table)}, Publish Time: {pub_time/1e9}, Last Fanout Time: {self.fanout.last_fanout_time/1e9}, Start Int: {(start - self.prev_pub_time)/1e9}, End Int: {(end - self.prev_pub_time)/1e9}")
             self.prev_pub_time = start
-        
-            
-    
+
+    ####################
+    # Encoding Methods #
+    ####################
+
+    def _changed_tickers(self, prices, previous):
+        """Indices of the tickers whose price differs from previous, or every ticker if previous is None
+        """
+        if previous is None:
+            return np.arange(len(prices))
+        return np.flatnonzero(prices != previous)
+
+    def _encode_packets(self, seq, stamp, indices, prices, snapshot):
+        """Binary tick packets for the given tickers, split so that every packet fits in a datagram
+        """
+        flags = TICK_FLAG_SNAPSHOT if snapshot else 0
+        entries = np.empty(len(indices), dtype=TICK_ENTRY_DTYPE)
+        entries["index"] = indices
+        entries["price"] = np.rint(prices * TICK_PRICE_SCALE)
+        packets = []
+        # an empty delta still goes out, so subscribers see the new sequence number and time
+        for lo in range(0, max(len(entries), 1), TICK_MAX_ENTRIES):
+            chunk = entries[lo:lo + TICK_MAX_ENTRIES]
+            packets.append(TICK_HEADER.pack(TICK_MAGIC, TICK_VERSION, flags, seq & 0xFFFFFFFF, stamp, len(chunk)) + chunk.tobytes())
+        return packets
+
+    def _json_updates(self, seq, stamp, indices, prices, snapshot):
+        """Json updates for the given tickers, split so that every update fits in a datagram
+        """
+        indices = indices.tolist()
+        prices = prices.tolist()
+        updates = []
+        for lo in range(0, max(len(indices), 1), TICK_MAX_JSON_ENTRIES):
+            update = {"type" : "stockmarketsimupdate", "time": stamp, "seq": seq, "snapshot": snapshot}
+            for i, price in zip(indices[lo:lo + TICK_MAX_JSON_ENTRIES], prices[lo:lo + TICK_MAX_JSON_ENTRIES]):
+                update[self.tickers[i]] = price
+            updates.append(update)
+        return updates
+
+    def _encode_json(self, seq, stamp, indices, prices, snapshot):
+        """Encoded json updates for the given tickers
+        """
+        return [json.dumps(update).encode("utf-8") for update in self._json_updates(seq, stamp, indices, prices, snapshot)]
+
+
+def parse_date(date):
+    """Unix timestamp of midnight UTC on a YYYY-MM-DD date
+    """
+    return datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+
 if __name__ == "__main__":
-    server = StockMarketSimulator(sys.argv[1])
-    server.simulate()
\ No newline at end of file
+    if len(sys.argv) == 2:
+        server = StockMarketSimulator(sys.argv[1])
+        server.simulate()
+    # time-warp replays every minute from the start date through the end date (inclusive)
+    elif len(sys.argv) == 5 and sys.argv[2] == "--warp":
+        try:
+            warp = (parse_date(sys.argv[3]), parse_date(sys.argv[4]) + 24 * 60 * 60)
+        except ValueError:
+            print("Error: dates must be in YYYY-MM-DD format")
+            exit(1)
+        server = StockMarketSimulator(sys.argv[1], warp=warp)
+        server.simulate_warp()
+    else:
+        print("Error: please enter the project name, optionally followed by --warp <start date> <end date>")
+        exit(1)
\ No newline at end of file
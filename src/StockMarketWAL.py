@@ -0,0 +1,211 @@
+# File: StockMarketWAL.py
+# Author: David Simonneti (dsimone2@nd.edu) & John Lee (jlee88@nd.edu)
+#
+# Description: Binary write-ahead log the replicators keep their transactions in, and the replay engine that reads it back.
+# Converting an old text transaction log:
+#   python StockMarketWAL.py <table.txn> <table.wal>
+
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+# start of every log file, the last byte is the format version
+WAL_MAGIC = b"SMWAL\x00\x00\x01"
+
+## Record types
+# interns a username as a user id, the records after it refer to the user by id
+REC_USER = 1
+# interns a ticker as a ticker id
+REC_TICKER = 2
+REC_REGISTER = 3
+REC_BUY = 4
+REC_SELL = 5
+# a user moved here from another chain, replacing any earlier copy, and a user that moved away
+REC_STORE = 6
+REC_DROP = 7
+
+## Record layouts, little endian and fixed width. Every record is framed by its payload length and the payload's CRC32,
+# and the payload starts with its type
+FRAME = struct.Struct("<II")
+# type, id, then the name in utf-8 for the rest of the payload
+INTERN = struct.Struct("<BI")
+# type, time in ns, user id, then the password in utf-8 for the rest of the payload
+REGISTER = struct.Struct("<BqI")
+# type, time in ns, user id, ticker id, amount, price
+TRADE = struct.Struct("<BqIHqd")
+# type, time in ns, user id, cash, number of holdings, then a holding per ticker held and the password in utf-8
+# for the rest of the payload
+STORE = struct.Struct("<BqIdH")
+# ticker id, amount
+HOLDING = struct.Struct("<Hq")
+# type, time in ns, user id
+DROP = struct.Struct("<BqI")
+
+class WriteAheadLog:
+    """Append only log of a replicator's transactions.
+
+    Usernames and tickers are written once per file and referred to by id after that.
+    Records are buffered by the file object, so they are only durable after sync.
+    """
+    def __init__(self, path):
+        # a new log starts over, its ids are only meaningful within the file
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(WAL_MAGIC)
+        # maps username / ticker -> id in this file
+        self.user_ids = {}
+        self.ticker_ids = {}
+
+    def _append(self, payload):
+        self.file.write(FRAME.pack(len(payload), zlib.crc32(payload)) + payload)
+
+    def _intern(self, ids, record_type, name):
+        """Id of a name, writing a record that defines it the first time it is used
+        """
+        key = ids.get(name)
+        if key is None:
+            key = ids[name] = len(ids)
+            self._append(INTERN.pack(record_type, key) + name.encode("utf-8"))
+        return key
+
+    def register(self, time_ns, username, password):
+        user_id = self._intern(self.user_ids, REC_USER, username)
+        self._append(REGISTER.pack(REC_REGISTER, time_ns, user_id) + password.encode("utf-8"))
+
+    def buy(self, time_ns, username, ticker, amount, price):
+        self._trade(REC_BUY, time_ns, username, ticker, amount, price)
+
+    def sell(self, time_ns, username, ticker, amount, price):
+        self._trade(REC_SELL, time_ns, username, ticker, amount, price)
+
+    def _trade(self, record_type, time_ns, username, ticker, amount, price):
+        user_id = self._intern(self.user_ids, REC_USER, username)
+        ticker_id = self._intern(self.ticker_ids, REC_TICKER, ticker)
+        self._append(TRADE.pack(record_type, time_ns, user_id, ticker_id, amount, price))
+
+    def store(self, time_ns, username, password, cash, stocks):
+        user_id = self._intern(self.user_ids, REC_USER, username)
+        holdings = b"".join(HOLDING.pack(self._intern(self.ticker_ids, REC_TICKER, ticker), amount) for ticker, amount in stocks.items())
+        self._append(STORE.pack(REC_STORE, time_ns, user_id, cash, len(stocks)) + holdings + password.encode("utf-8"))
+
+    def drop(self, time_ns, username):
+        self._append(DROP.pack(REC_DROP, time_ns, self._intern(self.user_ids, REC_USER, username)))
+
+    def sync(self):
+        """Makes every record written so far durable
+        """
+        self.file.flush()
+        os.fsync(self.file)
+
+    def close(self):
+        self.file.close()
+
+def replay(path):
+    """Yields the transactions of a log, read from a memory map:
+        ("REGISTER", time, username, password)
+        ("BUY" / "SELL", time, username, ticker, amount, price)
+        ("STORE", time, username, password, cash, {ticker: amount})
+        ("DROP", time, username)
+
+    Replay stops at the first record that is cut short or fails its CRC, which is where a crash interrupted a write.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < len(WAL_MAGIC):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if buffer[:len(WAL_MAGIC)] != WAL_MAGIC:
+                raise ValueError(f"{path} is not a transaction log")
+            # maps id -> username / ticker
+            users = []
+            tickers = []
+            offset = len(WAL_MAGIC)
+            crc32 = zlib.crc32
+            while offset + FRAME.size <= size:
+                length, crc = FRAME.unpack_from(buffer, offset)
+                start = offset + FRAME.size
+                end = start + length
+                if length == 0 or end > size:
+                    return
+                payload = buffer[start:end]
+                if crc32(payload) != crc:
+                    return
+                offset = end
+                record_type = payload[0]
+                if record_type == REC_BUY or record_type == REC_SELL:
+                    _, time_ns, user_id, ticker_id, amount, price = TRADE.unpack(payload)
+                    yield ("BUY" if record_type == REC_BUY else "SELL"), time_ns, users[user_id], tickers[ticker_id], amount, price
+                elif record_type == REC_REGISTER:
+                    _, time_ns, user_id = REGISTER.unpack_from(payload)
+                    yield "REGISTER", time_ns, users[user_id], payload[REGISTER.size:].decode("utf-8")
+                elif record_type == REC_STORE:
+                    _, time_ns, user_id, cash, count = STORE.unpack_from(payload)
+                    stocks = {}
+                    holding = STORE.size
+                    for _ in range(count):
+                        ticker_id, amount = HOLDING.unpack_from(payload, holding)
+                        stocks[tickers[ticker_id]] = amount
+                        holding += HOLDING.size
+                    yield "STORE", time_ns, users[user_id], payload[holding:].decode("utf-8"), cash, stocks
+                elif record_type == REC_DROP:
+                    _, time_ns, user_id = DROP.unpack(payload)
+                    yield "DROP", time_ns, users[user_id]
+                elif record_type == REC_USER:
+                    users.append(payload[INTERN.size:].decode("utf-8"))
+                elif record_type == REC_TICKER:
+                    tickers.append(payload[INTERN.size:].decode("utf-8"))
+
+def read_text_log(path):
+    """Yields the transactions of an old text log, like replay does.
+    Each line is TRANSACTION_LENGTH TIMESTAMP OPERATION USERNAME_LEN USERNAME ..., and lines whose length
+    does not match their TRANSACTION_LENGTH are half written transactions that are skipped
+    """
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                total_length, rest = line.rstrip("\n").split(" ", 1)
+                if len(rest) != int(total_length):
+                    continue
+                time_ns, operation, rest = rest.split(" ", 2)
+                username_len, rest = rest.split(" ", 1)
+                username = rest[:int(username_len)]
+                rest = rest[int(username_len) + 1:]
+                if operation == "REGISTER":
+                    pw_len, rest = rest.split(" ", 1)
+                    yield "REGISTER", int(time_ns), username, rest[:int(pw_len)]
+                elif operation in ("BUY", "SELL"):
+                    ticker, amount, price = rest.split(" ")
+                    yield operation, int(time_ns), username, ticker, int(float(amount)), float(price)
+            except ValueError:
+                continue
+
+def convert_text_log(text_path, wal_path):
+    """Rewrites an old text transaction log as a binary log. Returns how many transactions were converted.
+    The binary log only appears once it is complete
+    """
+    log = WriteAheadLog(wal_path + ".shadow")
+    count = 0
+    for txn in read_text_log(text_path):
+        if txn[0] == "REGISTER":
+            log.register(*txn[1:])
+        elif txn[0] == "BUY":
+            log.buy(*txn[1:])
+        else:
+            log.sell(*txn[1:])
+        count += 1
+    log.sync()
+    log.close()
+    os.replace(wal_path + ".shadow", wal_path)
+    return count
+
+def main():
+    if len(sys.argv) != 3:
+        print("Error: please enter the text transaction log and the binary log to write")
+        exit(1)
+    count = convert_text_log(sys.argv[1], sys.argv[2])
+    print(f"Converted {count} transactions")
+
+if __name__ == "__main__":
+    main()
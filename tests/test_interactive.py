@@ -69,7 +69,10 @@ def main():
                 
         elif inp == 'leaderboard':
             resp = sm.get_leaderboard()
-            print(resp)
+            if raw_mode:
+                print(resp)
+            else:
+                print(resp['Str'])
 
 if __name__ == "__main__":
     main()
@@ -75,6 +75,14 @@ def main():
     publishes = 0
     prev_update = first_up
     returns = defaultdict(list)
+    # warm up from the simulator's recent history instead of waiting for the first 100 publishes
+    history = sm.get_history(last=101)
+    if len(history) == 101:
+        for prev_tick, tick in zip(history, history[1:]):
+            for ticker in VALID_TICKERS:
+                returns[ticker].append(tick[ticker] - prev_tick[ticker])
+        publishes = 100
+        prev_update = history[-1]
     while True:
         update = sm.get_stock_update()
         
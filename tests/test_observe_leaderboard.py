@@ -8,7 +8,6 @@
 from StockMarketEndpoint import *
 import sys
 import time
-import re
 from collections import defaultdict
 
 if __name__ == '__main__':
@@ -25,18 +24,13 @@ if __name__ == '__main__':
         time.sleep(60)
         lb = sm.get_leaderboard()
         
-        # parse leaderboard
-        for row in lb:
-            m = re.search("(.*) | (.*)\n", row)
-            if m is None:
-                continue
-            else:
-                net_worths[m.group(1)].append(float(m.group(2)))
+        for row in lb["Rows"]:
+            net_worths[row["Username"]].append(row["Net Worth"])
                 
         # write output
         with open(file, 'a') as f:
             for user in sorted(net_worths.keys()):
-                f.write(net_worths[user][-1], end = ' ')
+                f.write(str(net_worths[user][-1]) + ' ')
             f.write('\n')
             
             
@@ -52,7 +52,7 @@ def main():
         if c % 10 == 0:
             print(sm.get_balance()['Str'])
         if c % 60 == 0:
-            print(sm.get_leaderboard())
+            print(sm.get_leaderboard()["Str"])
             
         c+=1    
 if __name__ == "__main__":